@@ -0,0 +1,799 @@
+"""
+offline benchmark of the HomematicIP exporter
+
+Runs the exporter against a synthetic home of a given size without a cloud
+connection and measures the initial REST sync, scrape latency, WebSocket
+event throughput and memory. Every size runs in a fresh interpreter so the
+results do not influence each other.
+
+    python benchmark.py --devices 100,1000,10000
+    python benchmark.py --devices 1000 --replay events.jsonl --output bench.json
+    python benchmark.py --devices 1000 --replay AP.events --replay-speed 10
+
+A replay file holds one raw WebSocket message per line, optionally preceded
+by the Unix time it was received as written by exporter.py --record-dir.
+With --replay-speed the messages are replayed at that multiple of their
+recorded pace, or as fast as possible with "max", and the latency of every
+message is reported.
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import statistics
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from prometheus_client import CollectorRegistry
+
+import exporter
+
+# device kinds of the synthetic home and their share
+DEVICE_MIX = (
+    ("WALL_MOUNTED_THERMOSTAT_PRO", 0.2),
+    ("HEATING_THERMOSTAT", 0.3),
+    ("FLOOR_TERMINAL_BLOCK_12", 0.05),
+    ("SHUTTER_CONTACT", 0.3),
+    ("PLUGABLE_SWITCH_MEASURING", 0.15),
+)
+DEVICES_PER_ROOM = 8
+HOME_ID = "00000000-0000-0000-0000-000000000000"
+
+# columns of the reports as (title, result key, format, scale)
+COLUMNS = (
+    ("devices", "devices", "{:d}", 1),
+    ("samples", "samples", "{:d}", 1),
+    ("sync ms", "initial_sync_seconds", "{:.1f}", 1e3),
+    ("cold ms", "scrape_cold_seconds", "{:.2f}", 1e3),
+    ("cached us", "scrape_cached_seconds", "{:.1f}", 1e6),
+    ("changed ms", "scrape_after_event_seconds", "{:.2f}", 1e3),
+    ("gzip ms", "scrape_gzip_seconds", "{:.2f}", 1e3),
+    ("events/s", "events_per_second", "{:.0f}", 1),
+    ("rss MiB", "peak_rss_bytes", "{:.1f}", 1.0 / 2**20),
+)
+REPLAY_COLUMNS = (
+    ("devices", "devices", "{:d}", 1),
+    ("messages", "messages", "{:d}", 1),
+    ("events", "events", "{:d}", 1),
+    ("wall s", "wall_seconds", "{:.1f}", 1),
+    ("events/s", "events_per_second", "{:.0f}", 1),
+    ("p50 us", "latency_p50_seconds", "{:.0f}", 1e6),
+    ("p90 us", "latency_p90_seconds", "{:.0f}", 1e6),
+    ("p99 us", "latency_p99_seconds", "{:.0f}", 1e6),
+    ("max ms", "latency_max_seconds", "{:.2f}", 1e3),
+    ("lag ms", "max_lag_seconds", "{:.1f}", 1e3),
+    ("rss growth MiB", "rss_growth_bytes", "{:.1f}", 1.0 / 2**20),
+)
+STARTUP_COLUMNS = (
+    ("devices", "devices", "{:d}", 1),
+    ("samples", "samples", "{:d}", 1),
+    ("first scrape ms", "first_scrape_seconds", "{:.0f}", 1e3),
+    ("setup ms", "setup_seconds", "{:.1f}", 1e3),
+    ("listen ms", "listen_seconds", "{:.1f}", 1e3),
+    ("rss MiB", "rss_bytes", "{:.1f}", 1.0 / 2**20),
+)
+
+
+def _channel(index, channel_type, **values):
+    channel = {
+        "index": index,
+        "groupIndex": index,
+        "label": "",
+        "functionalChannelType": channel_type,
+        "groups": [],
+    }
+    channel.update(values)
+    return channel
+
+
+def _base_channel(channel_type, rng, **values):
+    return _channel(
+        0,
+        channel_type,
+        unreach=False,
+        lowBat=False,
+        routerModuleSupported=False,
+        routerModuleEnabled=False,
+        rssiDeviceValue=rng.randint(-90, -40),
+        rssiPeerValue=rng.randint(-90, -40),
+        dutyCycle=False,
+        configPending=False,
+        supportedOptionalFeatures={},
+        **values,
+    )
+
+
+def synthetic_device(i, device_type, rng):
+    """
+    builds the REST representation of a device
+
+    :param i: the number of the device
+    :param device_type: one of the types in DEVICE_MIX
+    :param rng: the random.Random to draw values from
+    :return: the device as returned by the REST API
+    """
+    device_id = "3014F711A0000000{:08d}".format(i)
+    js = {
+        "id": device_id,
+        "homeId": HOME_ID,
+        "label": "device {}".format(i),
+        "type": device_type,
+        "lastStatusUpdate": int(time.time() * 1000) - rng.randint(0, 600000),
+        "firmwareVersion": "1.2.3",
+        "firmwareVersionInteger": 66051,
+        "availableFirmwareVersion": "0.0.0",
+        "updateState": "UP_TO_DATE",
+        "liveUpdateState": "LIVE_UPDATE_NOT_SUPPORTED",
+        "modelId": 1,
+        "modelType": device_type,
+        "oem": "eQ-3",
+        "manufacturerCode": 1,
+        "serializedGlobalTradeItemNumber": device_id,
+        "permanentlyReachable": device_type == "PLUGABLE_SWITCH_MEASURING",
+        "connectionType": "HMIP_RF",
+    }
+    if device_type == "WALL_MOUNTED_THERMOSTAT_PRO":
+        channels = [
+            _base_channel("DEVICE_OPERATIONLOCK", rng, operationLockActive=False),
+            _channel(
+                1,
+                "WALL_MOUNTED_THERMOSTAT_PRO_CHANNEL",
+                temperatureOffset=0.0,
+                display="ACTUAL",
+                actualTemperature=round(rng.uniform(17, 24), 1),
+                setPointTemperature=21.0,
+                humidity=rng.randint(35, 60),
+                vaporAmount=round(rng.uniform(5, 10), 2),
+            ),
+        ]
+    elif device_type == "HEATING_THERMOSTAT":
+        js["automaticValveAdaptionNeeded"] = False
+        channels = [
+            _base_channel("DEVICE_OPERATIONLOCK", rng, operationLockActive=False),
+            _channel(
+                1,
+                "HEATING_THERMOSTAT_CHANNEL",
+                temperatureOffset=0.0,
+                valvePosition=round(rng.random(), 2),
+                valveState="ADAPTION_DONE",
+                setPointTemperature=21.0,
+                valveActualTemperature=round(rng.uniform(17, 24), 1),
+            ),
+        ]
+    elif device_type == "FLOOR_TERMINAL_BLOCK_12":
+        channels = [
+            _base_channel(
+                "DEVICE_BASE_FLOOR_HEATING",
+                rng,
+                minimumFloorHeatingValvePosition=0.0,
+                valveProtectionDuration=5,
+                valveProtectionSwitchingInterval=14,
+                frostProtectionTemperature=8.0,
+                heatingEmergencyValue=0.25,
+                coolingEmergencyValue=0.0,
+                pulseWidthModulationAtLowFloorHeatingValvePositionEnabled=False,
+            )
+        ]
+        for index in range(1, 13):
+            channels.append(
+                _channel(
+                    index,
+                    "FLOOR_TERMINAL_BLOCK_MECHANIC_CHANNEL",
+                    label="zone {}".format(index),
+                    valveState="ADAPTION_DONE",
+                    valvePosition=round(rng.random(), 2),
+                    dewPointAlarmActive=False,
+                )
+            )
+    elif device_type == "SHUTTER_CONTACT":
+        channels = [
+            _base_channel("DEVICE_SABOTAGE", rng, sabotage=False),
+            _channel(
+                1,
+                "SHUTTER_CONTACT_CHANNEL",
+                windowState=rng.choice(("CLOSED", "OPEN", "TILTED")),
+                eventDelay=0,
+            ),
+        ]
+    else:
+        channels = [
+            _base_channel("DEVICE_BASE", rng),
+            _channel(
+                1,
+                "SWITCH_MEASURING_CHANNEL",
+                on=rng.random() < 0.5,
+                profileMode="AUTOMATIC",
+                userDesiredProfileMode="AUTOMATIC",
+                currentPowerConsumption=round(rng.uniform(0, 2000), 1),
+                energyCounter=round(rng.uniform(0, 5000), 3),
+            ),
+        ]
+    js["functionalChannels"] = {str(c["index"]): c for c in channels}
+    return js
+
+
+def synthetic_state(devices, seed=0):
+    """
+    builds the REST state of a home with the given number of devices
+
+    :param devices: the number of devices
+    :param seed: the seed of the random values
+    :return: the state as returned by download_configuration_async
+    """
+    rng = random.Random(seed)
+    types = [t for t, _ in DEVICE_MIX]
+    weights = [w for _, w in DEVICE_MIX]
+    device_states = {}
+    for i in range(devices):
+        js = synthetic_device(i, rng.choices(types, weights)[0], rng)
+        device_states[js["id"]] = js
+
+    groups = {}
+    device_ids = list(device_states)
+    for r, start in enumerate(range(0, devices, DEVICES_PER_ROOM)):
+        group_id = "00000000-0000-0000-0001-{:012d}".format(r)
+        groups[group_id] = {
+            "id": group_id,
+            "homeId": HOME_ID,
+            "label": "room {}".format(r),
+            "type": "META",
+            "lastStatusUpdate": 0,
+            "unreach": None,
+            "lowBat": None,
+            "sabotage": None,
+            "configPending": None,
+            "dutyCycle": None,
+            "incorrectPositioned": None,
+            "metaGroupId": None,
+            "groups": [],
+            "channels": [
+                {"deviceId": device_id, "channelIndex": 0}
+                for device_id in device_ids[start : start + DEVICES_PER_ROOM]
+            ],
+        }
+
+    home = {
+        "id": HOME_ID,
+        "currentAPVersion": "1.2.3",
+        "availableAPVersion": "1.2.3",
+        "updateState": "UP_TO_DATE",
+        "dutyCycle": 8.0,
+        "connected": True,
+        "pinAssigned": False,
+        "timeZoneId": "Europe/Berlin",
+        "powerMeterUnitPrice": 0.0,
+        "powerMeterCurrency": "EUR",
+        "deviceUpdateStrategy": "AUTOMATICALLY_IF_POSSIBLE",
+        "lastReadyForUpdateTimestamp": 0,
+        "apExchangeClientId": None,
+        "apExchangeState": "NONE",
+        "carrierSense": None,
+        "accessPointUpdateStates": {},
+        "ruleMetaDatas": {},
+        "functionalHomes": {},
+        "location": {"city": "Berlin", "latitude": "52.52", "longitude": "13.40"},
+        "weather": {
+            "temperature": 12.3,
+            "humidity": 70,
+            "vaporAmount": 6.0,
+            "windSpeed": 3.2,
+            "windDirection": 90,
+            "minTemperature": 5.0,
+            "maxTemperature": 15.0,
+            "weatherCondition": "CLEAR",
+            "weatherDayTime": "DAY",
+        },
+    }
+    return {"home": home, "devices": device_states, "groups": groups, "clients": {}}
+
+
+def synthetic_events(json_state, count, seed=1):
+    """
+    builds a stream of raw WebSocket messages for a home
+
+    Most messages change a value of a random device, some repeat its current
+    state and a few touch a room or the home, like the cloud does.
+
+    :param json_state: the state the events refer to
+    :param count: the number of messages
+    :param seed: the seed of the random values
+    :return: a list of raw messages
+    """
+    rng = random.Random(seed)
+    devices = list(json_state["devices"].values())
+    groups = list(json_state["groups"].values())
+    messages = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.01:
+            event = {"pushEventType": "HOME_CHANGED", "home": json_state["home"]}
+        elif roll < 0.03:
+            event = {"pushEventType": "GROUP_CHANGED", "group": rng.choice(groups)}
+        else:
+            js = copy.deepcopy(rng.choice(devices))
+            if roll < 0.8:
+                js["lastStatusUpdate"] += rng.randint(1000, 60000)
+                base = js["functionalChannels"]["0"]
+                base["rssiDeviceValue"] = rng.randint(-90, -40)
+                for channel in js["functionalChannels"].values():
+                    for key in (
+                        "actualTemperature",
+                        "valveActualTemperature",
+                        "valvePosition",
+                        "currentPowerConsumption",
+                    ):
+                        if key in channel:
+                            channel[key] = round(channel[key] + rng.uniform(-1, 1), 2)
+            event = {"pushEventType": "DEVICE_CHANGED", "device": js}
+        messages.append(json.dumps({"events": {"0": event}, "accessPointId": HOME_ID}))
+    return messages
+
+
+def load_replay(path):
+    """
+    reads raw WebSocket messages, one per line
+
+    :param path: the path of the replay file
+    :return: a list of (Unix time or None, raw message)
+    """
+    frames = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            if line.startswith("{"):
+                frames.append((None, line))
+            else:
+                timestamp, message = line.split(" ", 1)
+                frames.append((float(timestamp), message))
+    return frames
+
+
+class FakeHome(exporter.HomeClient):
+    """
+    HomeClient serving a fixed state without connecting to the cloud
+
+    Messages passed to deliver() go to the exporter's handler as the
+    WebSocket would pass them.
+    """
+
+    def __init__(self, json_state):
+        super().__init__()
+        self.json_state = json_state
+        self.events_enabled = asyncio.Event()
+        self.__handlers = []
+
+    async def init_async(self, access_point_id, auth_token=None):
+        pass
+
+    async def download_configuration_async(self):
+        return self.json_state
+
+    async def enable_events(self, additional_message_handler=None):
+        self.__handlers = []
+        if additional_message_handler:
+            self.__handlers.append(additional_message_handler)
+        self.events_enabled.set()
+
+    def websocket_is_connected(self):
+        return True
+
+    async def deliver(self, message):
+        for handler in self.__handlers:
+            await handler(message)
+
+
+def _collector(home, budget=None, writer=None, **args):
+    """
+    creates the collector of a home with the defaults of the exporter
+
+    :param home: the HomeClient of the home
+    :param budget: the RestBudget of the home, if any
+    :param writer: the RemoteWriter to push to, if any
+    :param args: the arguments overriding the defaults
+    """
+    defaults = dict(
+        rest_sync_interval=600,
+        rest_sync_max_interval=3600,
+        event_gap_timeout=900,
+        event_series_limit=1000,
+        stale_device_age=3600,
+        state_dir=None,
+        state_save_interval=300,
+        aggregate_window=0,
+        record_dir=None,
+    )
+    defaults.update(args)
+    config = exporter.load_configs(None, "benchmark", HOME_ID, logging.WARNING)[0]
+    return exporter.HomematicIPCollector(
+        argparse.Namespace(**defaults),
+        config,
+        home_client=home,
+        writer=writer,
+        budget=budget,
+    )
+
+
+def _timed(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def _peak_rss_bytes():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+async def measure(devices, messages, repeat):
+    """
+    runs the exporter against a synthetic home and measures it
+
+    :param devices: the number of devices of the home
+    :param messages: the raw WebSocket messages to replay, None for synthetic ones
+    :param repeat: how often the scrape measurements are repeated
+    :return: a dict of results
+    """
+    json_state = synthetic_state(devices)
+    if messages is None:
+        messages = synthetic_events(json_state, max(devices, 1000))
+    rss_before = _peak_rss_bytes()
+
+    home = FakeHome(json_state)
+    collector = exporter.MultiHomeCollector([_collector(home)])
+    registry = CollectorRegistry()
+    registry.register(collector)
+    server = exporter.MetricsServer(registry, 0)
+
+    start = time.perf_counter()
+    task = asyncio.create_task(collector.homes[0].start())
+    await home.events_enabled.wait()
+    initial_sync = time.perf_counter() - start
+
+    start = time.perf_counter()
+    body, _, _ = server.exposition("", "")
+    scrape_cold = time.perf_counter() - start
+    samples = sum(1 for line in body.splitlines() if not line.startswith(b"#"))
+
+    scrape_cached = _timed(lambda: server.exposition("", ""), repeat)
+    scrape_openmetrics = _timed(
+        lambda: server.exposition("application/openmetrics-text", ""), 1
+    )
+    scrape_gzip = _timed(lambda: server.exposition("", "gzip"), 1)
+
+    # a scrape after every change rebuilds the families and the exposition
+    changed = []
+    for message in messages[:repeat]:
+        await home.deliver(message)
+        start = time.perf_counter()
+        server.exposition("", "")
+        changed.append(time.perf_counter() - start)
+    scrape_changed = statistics.median(changed)
+
+    events = sum(len(json.loads(message)["events"]) for message in messages)
+    start = time.perf_counter()
+    for message in messages:
+        await home.deliver(message)
+    event_duration = time.perf_counter() - start
+
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+    return {
+        "devices": devices,
+        "samples": samples,
+        "exposition_bytes": len(body),
+        "initial_sync_seconds": initial_sync,
+        "scrape_cold_seconds": scrape_cold,
+        "scrape_cached_seconds": scrape_cached,
+        "scrape_openmetrics_seconds": scrape_openmetrics,
+        "scrape_gzip_seconds": scrape_gzip,
+        "scrape_after_event_seconds": scrape_changed,
+        "messages": len(messages),
+        "events_per_second": events / event_duration,
+        "peak_rss_bytes": _peak_rss_bytes(),
+        "peak_rss_growth_bytes": _peak_rss_bytes() - rss_before,
+    }
+
+
+def _percentile(values, q):
+    # values are sorted
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def replay(devices, frames, speed):
+    """
+    replays messages at their recorded pace against a synthetic home
+
+    :param devices: the number of devices of the home
+    :param frames: a list of (Unix time or None, raw message)
+    :param speed: the multiple of the recorded pace, 0 for as fast as possible
+    :return: a dict of results
+    """
+    home = FakeHome(synthetic_state(devices))
+    task = asyncio.create_task(_collector(home).start())
+    await home.events_enabled.wait()
+    rss_before = _rss_bytes(os.getpid())
+
+    first = next((timestamp for timestamp, _ in frames if timestamp), None)
+    latencies = []
+    max_lag = 0.0
+    start = time.perf_counter()
+    for timestamp, message in frames:
+        if speed and first is not None and timestamp is not None:
+            due = start + (timestamp - first) / speed
+            now = time.perf_counter()
+            if due > now:
+                await asyncio.sleep(due - now)
+            else:
+                max_lag = max(max_lag, now - due)
+        begin = time.perf_counter()
+        await home.deliver(message)
+        latencies.append(time.perf_counter() - begin)
+    wall = time.perf_counter() - start
+    rss_growth = _rss_bytes(os.getpid()) - rss_before
+
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+    latencies.sort()
+    events = sum(len(json.loads(message)["events"]) for _, message in frames)
+    return {
+        "devices": devices,
+        "messages": len(frames),
+        "events": events,
+        "speed": speed,
+        "wall_seconds": wall,
+        "events_per_second": events / sum(latencies),
+        "latency_p50_seconds": _percentile(latencies, 0.5),
+        "latency_p90_seconds": _percentile(latencies, 0.9),
+        "latency_p99_seconds": _percentile(latencies, 0.99),
+        "latency_max_seconds": latencies[-1],
+        "max_lag_seconds": max_lag,
+        "rss_growth_bytes": rss_growth,
+    }
+
+
+async def _save_snapshot(devices, state_dir):
+    home = FakeHome(synthetic_state(devices))
+    task = asyncio.create_task(_collector(home, state_dir=state_dir).start())
+    # the snapshot is saved right after the initial sync
+    await home.events_enabled.wait()
+    task.cancel()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rss_bytes(pid):
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def measure_startup(devices, repeat):
+    """
+    starts exporter.py with a saved snapshot and waits for the first scrape
+
+    The exporter is started like in the container. Its cloud connection runs
+    against an unreachable proxy, so the saved snapshot is what it serves.
+
+    :param devices: the number of devices of the saved home
+    :param repeat: how often the exporter is started
+    :return: a dict of median results
+    """
+    env = dict(os.environ, NO_PROXY="")
+    for name in ("HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY"):
+        env[name] = "http://127.0.0.1:9"
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+    runs = []
+    with tempfile.TemporaryDirectory() as state_dir:
+        asyncio.run(_save_snapshot(devices, state_dir))
+        for _ in range(repeat):
+            port = _free_port()
+            command = [
+                sys.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "exporter.py"),
+                "--metric-port={}".format(port),
+                "--auth-token=benchmark",
+                "--access-point={}".format(HOME_ID),
+                "--state-dir={}".format(state_dir),
+            ]
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            try:
+                while True:
+                    try:
+                        url = "http://127.0.0.1:{}/metrics".format(port)
+                        body = opener.open(url, timeout=5).read().decode()
+                        break
+                    except OSError:
+                        if process.poll() is not None:
+                            raise RuntimeError("exporter.py exited during startup")
+                        time.sleep(0.002)
+                first_scrape = time.perf_counter() - start
+                rss = _rss_bytes(process.pid)
+            finally:
+                process.terminate()
+                process.wait()
+
+            phases = {}
+            for line in body.splitlines():
+                if line.startswith("hmip_exporter_startup_phase_seconds{"):
+                    phase = line.split('"')[1]
+                    phases[phase + "_seconds"] = float(line.rsplit(" ", 1)[1])
+            runs.append(
+                dict(
+                    phases,
+                    first_scrape_seconds=first_scrape,
+                    rss_bytes=rss,
+                    samples=sum(
+                        1 for line in body.splitlines() if not line.startswith("#")
+                    ),
+                )
+            )
+
+    result = {"devices": devices}
+    for key in runs[0]:
+        result[key] = statistics.median_low(run.get(key, 0) for run in runs)
+    return result
+
+
+def run_isolated(devices, options):
+    """
+    measures one home size in a fresh interpreter
+
+    :param devices: the number of devices
+    :param options: the parsed command line
+    :return: a dict of results
+    """
+    command = [
+        sys.executable,
+        __file__,
+        "--devices",
+        str(devices),
+        "--repeat",
+        str(options.repeat),
+        "--inline",
+    ]
+    if options.replay:
+        command += ["--replay", options.replay]
+    if options.replay_speed:
+        command += ["--replay-speed", options.replay_speed]
+    output = subprocess.run(command, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout)
+
+
+def report(results, columns=COLUMNS):
+    """
+    formats results as a table
+
+    :param results: a list of result dicts
+    :param columns: the columns of the table
+    :return: the table as a string
+    """
+    rows = [[c[0] for c in columns]]
+    for result in results:
+        rows.append([fmt.format(result[key] * scale) for _, key, fmt, scale in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join(
+        "  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark of the HomematicIP Prometheus Exporter",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--devices",
+        default="100,1000,10000",
+        help="comma separated numbers of devices of the synthetic homes",
+    )
+    parser.add_argument(
+        "--replay",
+        default=None,
+        help="file of raw WebSocket messages to replay instead of synthetic ones",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        default=None,
+        help="replay --replay at this multiple of its recorded pace, or as fast "
+        "as possible with max, and report the latency per message",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=50, help="repetitions of the scrape measurements"
+    )
+    parser.add_argument(
+        "--output", default=None, help="write the results as JSON to this file"
+    )
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="measure the time from starting exporter.py with a saved snapshot "
+        "to its first scrape instead",
+    )
+    parser.add_argument("--inline", action="store_true", help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    sizes = [int(size) for size in options.devices.split(",")]
+
+    if options.replay_speed and not options.replay:
+        parser.error("--replay-speed requires --replay")
+
+    if options.inline:
+        frames = load_replay(options.replay) if options.replay else None
+        if options.replay_speed:
+            speed = 0 if options.replay_speed == "max" else float(options.replay_speed)
+            result = asyncio.run(replay(sizes[0], frames, speed))
+        else:
+            messages = [message for _, message in frames] if frames else None
+            result = asyncio.run(measure(sizes[0], messages, options.repeat))
+        json.dump(result, sys.stdout)
+        return
+
+    if options.startup:
+        results = [measure_startup(size, min(options.repeat, 10)) for size in sizes]
+        print(report(results, STARTUP_COLUMNS))
+    else:
+        results = [run_isolated(size, options) for size in sizes]
+        print(report(results, REPLAY_COLUMNS if options.replay_speed else COLUMNS))
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "homematicip": _version("homematicip"),
+                    "prometheus_client": _version("prometheus_client"),
+                    "replay": options.replay,
+                    "replay_speed": options.replay_speed,
+                    "startup": options.startup,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+def _version(package):
+    from importlib.metadata import version
+
+    return version(package)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,466 +1,2523 @@
 import argparse
+import collections
+import configparser
+import functools
+import gzip
+import heapq
+import importlib
+import json
+import random
+import re
+import struct
 import sys
 import logging
+import marshal
+import os
+import threading
+import time
+import weakref
 import homematicip
 import prometheus_client
 import asyncio
-from prometheus_client import Counter
-from prometheus_client.core import GaugeMetricFamily
-from homematicip.async_home import AsyncHome
-from homematicip.device import WallMountedThermostatPro, FloorTerminalBlock12
-from homematicip.base.functionalChannels import FloorTerminalBlockMechanicChannel
+import aiohttp
+from aiohttp import web
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, Metric
+from prometheus_client.exposition import choose_encoder, gzip_accepted
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)-15s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
 )
 
+# label identifying the home of every series
+HOME_LABELNAMES = ["access_point"]
+LABELNAMES = ["room", "device_label"]
+DETAIL_LABELNAMES = [
+    "device_type",
+    "firmware_version",
+    "permanently_reachable",
+    "device_id",
+    "model_type",
+    "connection_type",
+]
+CHANNEL_LABELNAMES = LABELNAMES + ["channel", "channel_name"]
+
+# (name, documentation, labels) of all exported gauges in exposition order
+METRIC_FAMILIES = (
+    # Home Metrics
+    ("hmip_version_info", "HomematicIP info", ["api_version"]),
+    ("hmip_duty_cycle", "The current duty cycle of the access point", []),
+    # Device Metrics
+    ("hmip_current_temperature_celsius", "Actual temperature", LABELNAMES),
+    ("hmip_set_temperature_celsius", "Set point temperature", LABELNAMES),
+    ("hmip_valve_adaption_needed", "must the adaption re-run?", LABELNAMES),
+    (
+        "hmip_temperature_offset",
+        "the offset temperature for the thermostat",
+        LABELNAMES,
+    ),
+    (
+        "hmip_heating_valve_position",
+        "the current position of the valve 0.0 = closed, 1.0 max opened",
+        CHANNEL_LABELNAMES,
+    ),
+    ("hmip_current_humidity_relative", "Actual Humidity", LABELNAMES),
+    ("hmip_vapor_amount", "Vapor Amount", LABELNAMES),
+    ("hmip_low_bat", "Low Battery", LABELNAMES),
+    ("hmip_unreachable", "Unreachable", LABELNAMES),
+    ("hmip_config_pending", "Configuration Pending", LABELNAMES),
+    ("hmip_duty_cycle_limited", "Duty Cycle Reached", LABELNAMES),
+    ("hmip_valve_protection_duration", "Valve Protection Duration", LABELNAMES),
+    (
+        "hmip_valve_protection_switching_interval",
+        "Valve Protection Switching Interval",
+        LABELNAMES,
+    ),
+    # Weather Metrics
+    ("hmip_weather_temperature", "Weather Temperature", ["location"]),
+    ("hmip_weather_humidity", "Weather Humidity", ["location"]),
+    ("hmip_weather_vapor_amount", "Weather Vapor Amount", ["location"]),
+    ("hmip_weather_wind_speed", "Wind Speed", ["location"]),
+    ("hmip_weather_min_temperature", "Minimum Temperature", ["location"]),
+    ("hmip_weather_max_temperature", "Maximum Temperature", ["location"]),
+    # Device Metrics
+    ("hmip_rssi_device_value", "RSSI device value", LABELNAMES),
+    ("hmip_rssi_peer_value", "RSSI peer value", LABELNAMES),
+    ("hmip_last_status_update", "Device last status update", LABELNAMES),
+    ("hmip_valve_flow_error", "Valve Flow Error", LABELNAMES),
+    ("hmip_valve_water_error", "Valve Water Error", LABELNAMES),
+    (
+        "hmip_minimum_floor_heating_valve_position",
+        "Minimum Floor Heating Valve Position",
+        LABELNAMES,
+    ),
+    ("hmip_dew_point_alarm_active", "Dew Point Alarm Active", CHANNEL_LABELNAMES),
+    (
+        "hmip_window_state",
+        "the state of the window 0 = closed, 1 = open, 2 = tilted",
+        LABELNAMES,
+    ),
+    ("hmip_switch_on", "Switch On", LABELNAMES),
+    ("hmip_power_consumption_watts", "Current power consumption", LABELNAMES),
+    ("hmip_energy_counter_kwh", "Energy counter", LABELNAMES),
+    ("hmip_device_info", "Device information", LABELNAMES + DETAIL_LABELNAMES),
+)
+
+# families that are only exposed when they carry a sample
+OPTIONAL_METRIC_FAMILIES = {"hmip_version_info", "hmip_duty_cycle"}
+
+# families of continuous values that are also aggregated per window
+WINDOW_METRIC_FAMILIES = (
+    "hmip_current_temperature_celsius",
+    "hmip_set_temperature_celsius",
+    "hmip_heating_valve_position",
+    "hmip_current_humidity_relative",
+    "hmip_vapor_amount",
+    "hmip_power_consumption_watts",
+)
+# (suffix, documentation) of the aggregates exported per window family
+WINDOW_AGGREGATES = (
+    ("_window_min", "minimum"),
+    ("_window_max", "maximum"),
+    ("_window_mean", "time-weighted mean"),
+    ("_window_samples", "number of values, including the initial one,"),
+)
+
+# label names of every family including the access point, in sample order
+FAMILY_LABELNAMES = {
+    name: ("__name__", *HOME_LABELNAMES, *labels)
+    for name, documentation, labels in METRIC_FAMILIES
+}
+
+# immutable view of the home handed from the event loop to the scrape thread.
+# It is never modified in place, only replaced as a whole.
+Snapshot = collections.namedtuple(
+    "Snapshot", ["groups", "home_samples", "device_samples"]
+)
+
+# first retry delay in seconds after a failed REST sync, doubled per failure
+SYNC_RETRY_DELAY = 30
+# first retry delay in seconds after the cloud throttled a REST sync
+SYNC_THROTTLED_RETRY_DELAY = 300
+# share of stale devices above which a full sync replaces the targeted one
+FULL_SYNC_STALE_RATIO = 0.25
+# order in which REST syncs waiting for the budget are served. Catch-up
+# syncs follow reconnects and failed full syncs, when events may have been
+# missed. The initial sync of a home doesn't wait, but takes its token too.
+SYNC_PRIORITIES = {"initial": 0, "catch_up": 1, "routine": 2}
+
+# first delay in seconds before a failed home or push task is restarted,
+# doubled per failure up to TASK_MAX_RESTART_DELAY
+TASK_RESTART_DELAY = 5
+TASK_MAX_RESTART_DELAY = 300
+
+# seconds between checks of the WebSocket by the supervisor
+WEBSOCKET_CHECK_INTERVAL = 5
+# seconds a WebSocket may stay disconnected before the supervisor restarts
+# it, doubled per restart up to WEBSOCKET_MAX_RESTART_DELAY. This bounds the
+# backoff of the homematicip client, which grows to 15 minutes.
+WEBSOCKET_RESTART_DELAY = 30
+WEBSOCKET_MAX_RESTART_DELAY = 300
+
+# query parameters of /metrics selecting families and devices
+Selection = collections.namedtuple("Selection", ["names", "rooms", "devices", "types"])
+SELECTION_PARAMETERS = ("name[]", "room", "device", "type")
+# selections whose gzip members are cached, beyond it the cache is reset
+EXPOSITION_CACHE_SIZE = 64
+# runs of unchanged families are gzip-compressed into members of about this
+# many bytes, which are reused while the families stay the same
+GZIP_MEMBER_SIZE = 65536
+
+# samples kept for remote write while the receiver is unreachable, the
+# oldest are dropped beyond it
+PUSH_MAX_PENDING = 50000
+# seconds after which a remote write request is abandoned and retried
+PUSH_TIMEOUT = 30
+# seconds after which every series is pushed again, well below the lookback
+# of the receiver (5 minutes in Prometheus), in steps of a share of the
+# devices each
+PUSH_REFRESH_INTERVAL = 60
+PUSH_REFRESH_STEPS = 10
+# Prometheus staleness marker, pushed for series that disappeared
+PUSH_STALE_MARKER = struct.pack("<Q", 0x7FF0000000000002)
+PUSH_HEADERS = {
+    "Content-Encoding": "snappy",
+    "Content-Type": "application/x-protobuf",
+    "X-Prometheus-Remote-Write-Version": "0.1.0",
+}
+
+# id label of the series counting events beyond --event-series-limit
+EVENT_OVERFLOW_ID = "overflow"
+
+# buckets of hmip_rest_sync_duration_seconds, a sync may wait for the
+# cloud's rate limit
+SYNC_DURATION_BUCKETS = (0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# self-instrumentation shared by all homes
+EVENT_BYTES = Counter(
+    "hmip_websocket_events_bytes_total",
+    "Total bytes received from HomematicIP WebSocket",
+    HOME_LABELNAMES,
+)
+COLLECT_DURATION = Histogram(
+    "hmip_exporter_collect_duration_seconds",
+    "Time spent building the metric families on scrape",
+)
+SCRAPE_DURATION = Histogram(
+    "hmip_exporter_scrape_duration_seconds",
+    "Time spent serving a scrape, including collecting, encoding and compressing",
+    ["encoding"],
+)
+SYNC_DURATION = Histogram(
+    "hmip_rest_sync_duration_seconds",
+    "Duration of REST syncs including failed ones",
+    HOME_LABELNAMES + ["scope"],
+    buckets=SYNC_DURATION_BUCKETS,
+)
+SYNC_FAILURES = Counter(
+    "hmip_rest_sync_failures_total",
+    "Number of failed REST syncs",
+    HOME_LABELNAMES + ["reason"],
+)
+COLLECTION_ERRORS = Counter(
+    "hmip_collection_errors_total",
+    "Number of devices and events that could not be turned into samples",
+    HOME_LABELNAMES + ["source", "device_type"],
+)
+LAST_SYNC_TIMESTAMP = Gauge(
+    "hmip_last_rest_sync_timestamp_seconds",
+    "Unix time of the last successful REST sync",
+    HOME_LABELNAMES,
+)
+LAST_EVENT_TIMESTAMP = Gauge(
+    "hmip_last_websocket_event_timestamp_seconds",
+    "Unix time of the last message received from HomematicIP WebSocket",
+    HOME_LABELNAMES,
+)
+HOME_UP = Gauge(
+    "hmip_home_up",
+    "Whether the home is connected, 0 while its initialization is retried",
+    HOME_LABELNAMES,
+)
+STARTUP_PHASE = Gauge(
+    "hmip_exporter_startup_phase_seconds",
+    "Duration of the startup phases: setup of the homes, binding the metrics "
+    "endpoint and connecting all homes",
+    ["phase"],
+)
+WEBSOCKET_CONNECTED = Gauge(
+    "hmip_websocket_connected",
+    "Whether the WebSocket of the home is connected",
+    HOME_LABELNAMES,
+)
+WEBSOCKET_RECONNECTS = Counter(
+    "hmip_websocket_reconnects_total",
+    "Number of WebSocket connections established after the connection was lost",
+    HOME_LABELNAMES,
+)
+WEBSOCKET_RESTARTS = Counter(
+    "hmip_websocket_restarts_total",
+    "Number of WebSocket subscriptions restarted by the exporter",
+    HOME_LABELNAMES + ["reason"],
+)
+TASK_RESTARTS = Counter(
+    "hmip_exporter_task_restarts",
+    "Number of times the task of a home, named by its access point, or the push "
+    "task failed and was restarted",
+    ["task"],
+)
+HOME_STALE = Gauge(
+    "hmip_home_stale",
+    "Whether the metrics of the home are served from the snapshot on disk",
+    HOME_LABELNAMES,
+)
+
+PUSH_SAMPLES = Counter(
+    "hmip_push_samples",
+    "Number of samples pushed via remote write by outcome",
+    ["outcome"],
+)
+PUSH_DURATION = Histogram(
+    "hmip_push_duration_seconds",
+    "Duration of remote write requests",
+)
+PUSH_FAILURES = Counter(
+    "hmip_push_failures",
+    "Number of failed remote write requests by reason",
+    ["reason"],
+)
+PUSH_PENDING = Gauge(
+    "hmip_push_pending_samples",
+    "Number of samples waiting to be pushed via remote write",
+)
+
+REST_CALLS = Counter(
+    "hmip_rest_calls",
+    "Number of REST syncs sent to the cloud by priority",
+    HOME_LABELNAMES + ["priority"],
+)
+REST_BUDGET = Gauge(
+    "hmip_rest_budget_remaining",
+    "Number of REST syncs the budget of the account of the home allows right away",
+    HOME_LABELNAMES,
+)
+
+# version of the snapshot files in --state-dir, files of other versions are
+# ignored
+SNAPSHOT_FORMAT = 1
+
+# a value exported from a functional channel. The value is read from key,
+# falling back to default, and exported through convert if keep accepts it.
+# Fields with a feature are only exported by devices announcing it in the
+# supportedOptionalFeatures of their base channel.
+Field = collections.namedtuple(
+    "Field", ["metric", "key", "convert", "keep", "default", "feature"]
+)
+
+
+def value_field(metric, key):
+    """
+    a field exported as is unless it is missing
+    """
+    return Field(metric, key, float, _is_set, None, None)
+
+
+def nonzero_field(metric, key):
+    """
+    a field exported as is unless it is missing or zero
+    """
+    return Field(metric, key, float, bool, None, None)
+
+
+def flag_field(metric, key, default=None, feature=None):
+    """
+    a boolean field exported as 0 or 1 unless it is missing
+    """
+    return Field(metric, key, int, _is_set, default, feature)
+
+
+def mapped_field(metric, key, mapping):
+    """
+    an enum field exported as the number mapping assigns to it
+    """
+    return Field(metric, key, mapping.get, mapping.__contains__, None, None)
+
+
+def _is_set(v):
+    return v is not None
+
+
+# reads the fields from the base channel of the device
+BASE_CHANNEL = None
+
+# rules exporting the values of functional channels as (names of
+# homematicip.device classes, channel types or BASE_CHANNEL, one series per
+# channel, fields). Series of per channel rules carry the channel index and
+# label.
+METRIC_RULES = (
+    (
+        ("Device",),
+        BASE_CHANNEL,
+        False,
+        (
+            nonzero_field("hmip_rssi_device_value", "rssiDeviceValue"),
+            nonzero_field("hmip_rssi_peer_value", "rssiPeerValue"),
+            flag_field("hmip_low_bat", "lowBat", default=False),
+            flag_field("hmip_unreachable", "unreach", default=False),
+            flag_field("hmip_config_pending", "configPending", default=False),
+            flag_field("hmip_duty_cycle_limited", "dutyCycle", default=False),
+        ),
+    ),
+    (
+        ("WallMountedThermostatPro",),
+        {
+            "WALL_MOUNTED_THERMOSTAT_PRO_CHANNEL",
+            "WALL_MOUNTED_THERMOSTAT_WITH_CARBON_CHANNEL",
+        },
+        False,
+        (
+            nonzero_field("hmip_current_temperature_celsius", "actualTemperature"),
+            nonzero_field("hmip_set_temperature_celsius", "setPointTemperature"),
+            nonzero_field("hmip_current_humidity_relative", "humidity"),
+            nonzero_field("hmip_vapor_amount", "vaporAmount"),
+            value_field("hmip_temperature_offset", "temperatureOffset"),
+        ),
+    ),
+    (
+        ("HeatingThermostat", "HeatingThermostatCompact", "HeatingThermostatEvo"),
+        {"HEATING_THERMOSTAT_CHANNEL"},
+        False,
+        (
+            nonzero_field("hmip_current_temperature_celsius", "valveActualTemperature"),
+            nonzero_field("hmip_set_temperature_celsius", "setPointTemperature"),
+            value_field("hmip_temperature_offset", "temperatureOffset"),
+        ),
+    ),
+    (
+        ("HeatingThermostat", "HeatingThermostatCompact", "HeatingThermostatEvo"),
+        {"HEATING_THERMOSTAT_CHANNEL"},
+        True,
+        (value_field("hmip_heating_valve_position", "valvePosition"),),
+    ),
+    (
+        ("FloorTerminalBlock12",),
+        BASE_CHANNEL,
+        False,
+        (
+            value_field("hmip_valve_protection_duration", "valveProtectionDuration"),
+            value_field(
+                "hmip_valve_protection_switching_interval",
+                "valveProtectionSwitchingInterval",
+            ),
+            value_field(
+                "hmip_minimum_floor_heating_valve_position",
+                "minimumFloorHeatingValvePosition",
+            ),
+            flag_field(
+                "hmip_valve_flow_error",
+                "valveFlowError",
+                feature="IOptionalFeatureDeviceValveError",
+            ),
+            flag_field(
+                "hmip_valve_water_error",
+                "valveWaterError",
+                feature="IOptionalFeatureDeviceWaterError",
+            ),
+        ),
+    ),
+    (
+        ("FloorTerminalBlock12",),
+        {"FLOOR_TERMINAL_BLOCK_MECHANIC_CHANNEL"},
+        True,
+        (
+            value_field("hmip_heating_valve_position", "valvePosition"),
+            flag_field("hmip_dew_point_alarm_active", "dewPointAlarmActive"),
+        ),
+    ),
+    (
+        ("ShutterContact", "ShutterContactMagnetic"),
+        {"SHUTTER_CONTACT_CHANNEL"},
+        False,
+        (
+            mapped_field(
+                "hmip_window_state",
+                "windowState",
+                {"CLOSED": 0, "OPEN": 1, "TILTED": 2},
+            ),
+        ),
+    ),
+    (
+        ("SwitchMeasuring",),
+        {"SWITCH_MEASURING_CHANNEL"},
+        False,
+        (
+            flag_field("hmip_switch_on", "on"),
+            value_field("hmip_power_consumption_watts", "currentPowerConsumption"),
+            value_field("hmip_energy_counter_kwh", "energyCounter"),
+        ),
+    ),
+)
+
+
+@functools.cache
+def device_class(device_type):
+    """
+    resolves the homematicip class of a device type
+
+    :param device_type: the type of a device as sent by the cloud
+    :return: the device class, Device for unknown types
+    """
+    # like the client, the device classes are imported on first use to keep
+    # them off the path to the first scrape
+    from homematicip.class_maps import TYPE_CLASS_MAP
+    from homematicip.device import Device
+
+    return TYPE_CLASS_MAP.get(device_type, Device)
+
+
+@functools.cache
+def device_rules(device_type):
+    """
+    compiles the rules that apply to a device type
+
+    :param device_type: the type of a device as sent by the cloud
+    :return: a tuple of (channel types or BASE_CHANNEL, per channel, fields)
+    """
+    import homematicip.device
+
+    cls = device_class(device_type)
+    return tuple(
+        (channel_types, per_channel, fields)
+        for names, channel_types, per_channel, fields in METRIC_RULES
+        if issubclass(cls, tuple(getattr(homematicip.device, n) for n in names))
+    )
+
+
+class HomeClient(object):
+    """
+    Client of the HomematicIP cloud that keeps no model of the home
+
+    It offers the part of the AsyncHome interface the exporter uses, but
+    REST syncs only return the raw state and WebSocket messages are only
+    passed to the given handler. The object graph of every device, group
+    and channel the library would parse is never built, so memory and sync
+    cost depend on the exported fields alone.
+    """
+
+    def __init__(self):
+        self.__context = None
+        self.__connection = None
+        self.__websocket = None
+
+    async def init_async(self, access_point_id, auth_token):
+        """
+        looks up the cloud endpoints of the access point
+
+        :param access_point_id: the access point id
+        :param auth_token: the auth token
+        """
+        # imported in a thread, so the loop answers scrapes meanwhile
+        for module in ("connection_factory", "websocket_handler"):
+            await asyncio.to_thread(
+                importlib.import_module, "homematicip.connection." + module
+            )
+        from homematicip.connection.connection_context import ConnectionContextBuilder
+        from homematicip.connection.connection_factory import ConnectionFactory
+
+        self.__context = await ConnectionContextBuilder.build_context_async(
+            accesspoint_id=access_point_id, auth_token=auth_token
+        )
+        self.__connection = ConnectionFactory.create_connection(self.__context)
+
+    async def download_configuration_async(self):
+        """
+        downloads the current state
+
+        :return: the state as returned by the REST API
+        """
+        from homematicip.connection.client_characteristics_builder import (
+            ClientCharacteristicsBuilder,
+        )
+        from homematicip.exceptions.connection_exceptions import (
+            HmipAuthenticationError,
+            HmipConnectionError,
+        )
+
+        result = await self.__connection.async_post(
+            "home/getCurrentState",
+            ClientCharacteristicsBuilder.get(self.__context.accesspoint_id),
+        )
+        if not result.success:
+            error = (
+                HmipAuthenticationError if result.status == 403 else HmipConnectionError
+            )
+            raise error(
+                "Could not get the current configuration. Error: {} {}".format(
+                    result.status, result.status_text
+                )
+            )
+        return result.json
+
+    async def enable_events(self, additional_message_handler=None):
+        """
+        subscribes to the WebSocket, reconnecting with backoff
+
+        :param additional_message_handler: called with every raw message
+        """
+        from homematicip.connection.websocket_handler import WebsocketHandler
+
+        if self.__websocket and self.__websocket.is_connected():
+            return
+        self.__websocket = WebsocketHandler()
+        if additional_message_handler:
+            self.__websocket.add_on_message_handler(additional_message_handler)
+        await self.__websocket.start(self.__context)
+
+    async def disable_events_async(self):
+        if self.__websocket:
+            await self.__websocket.stop()
+            self.__websocket = None
+
+    def websocket_is_connected(self):
+        return self.__websocket.is_connected() if self.__websocket else False
+
+    def set_on_connected_handler(self, handler):
+        if self.__websocket:
+            self.__websocket.add_on_connected_handler(handler)
+
+    def set_on_disconnected_handler(self, handler):
+        if self.__websocket:
+            self.__websocket.add_on_disconnected_handler(handler)
+
+    def set_on_reconnect_handler(self, handler):
+        if self.__websocket:
+            self.__websocket.add_on_reconnect_handler(handler)
+
 
 class HomematicIPCollector(object):
     """
-    Prometheus Exporter for Homematic IP devices
+    Prometheus Exporter for Homematic IP devices
+    """
+
+    def __init__(self, args, config, home_client=None, writer=None, budget=None):
+        """
+        initializes the exporter
+
+        :param args: the argparse.Args
+        :param config: the HmipConfig of the home
+        :param home_client: the HomeClient to use, a new one by default
+        :param writer: the RemoteWriter to push changes from events to, if any
+        :param budget: the RestBudget limiting the REST syncs, if any
+        """
+
+        self.__config = config
+        self.__access_point = config.access_point
+        self.__rest_sync_interval = int(args.rest_sync_interval)
+        self.__rest_sync_max_interval = int(args.rest_sync_max_interval)
+        self.__event_gap_timeout = int(args.event_gap_timeout)
+        self.__stale_device_age = int(args.stale_device_age)
+        self.__state_save_interval = int(args.state_save_interval)
+        file_name = re.sub(r"[^\w.-]", "_", self.__access_point)
+        self.__state_file = None
+        if args.state_dir:
+            self.__state_file = os.path.join(
+                args.state_dir, "{}.snapshot".format(file_name)
+            )
+        self.__record_file = None
+        if args.record_dir:
+            self.__record_file = os.path.join(
+                args.record_dir, "{}.events".format(file_name)
+            )
+        # lines of the messages not yet written, None while not recording,
+        # and the task writing them
+        self.__record_lines = None
+        self.__record_pending = asyncio.Event()
+        self.__recorder = None
+
+        # snapshot of the samples served on scrape, kept up to date by events
+        # and REST syncs
+        self.__snapshot = Snapshot({}, (), {})
+        self.__families_lock = threading.Lock()
+        self.__families_snapshot = None
+        self.__families = ()
+
+        # WebSocket health, used to schedule the REST syncs
+        self.__last_event = time.monotonic()
+        self.__websocket_lost = False
+        self.__resync_requested = asyncio.Event()
+        self.__last_full_sync = time.monotonic()
+        # the devices of the last full sync, including those that failed
+        self.__full_sync_devices = None
+
+        self.__home_client = home_client
+        self.__budget = budget
+        if budget is not None:
+            REST_BUDGET.labels(self.__access_point).set_function(budget.remaining)
+        self.__event_counter = EventCounter(
+            int(args.event_series_limit), self.__access_point
+        )
+        self.__event_byte_counter = EVENT_BYTES.labels(self.__access_point)
+        self.__last_event_timestamp = LAST_EVENT_TIMESTAMP.labels(self.__access_point)
+        self.__last_sync_timestamp = LAST_SYNC_TIMESTAMP.labels(self.__access_point)
+        self.__up = HOME_UP.labels(self.__access_point)
+        self.__up.set(0)
+        self.__websocket_connected = WEBSOCKET_CONNECTED.labels(self.__access_point)
+        self.__websocket_connected.set(0)
+        self.__stale = HOME_STALE.labels(self.__access_point)
+        self.__stale.set(0)
+
+        # the snapshot last written to --state-dir and the time of the sync
+        # it is based on
+        self.__saved_snapshot = None
+        self.__last_sync_time = None
+        self.__saver = None
+        self.__connected = asyncio.Event()
+        self.__load_snapshot()
+
+        # the rooms of every device, cached for the groups they stem from
+        self.__writer = writer
+        self.__device_rooms_groups = None
+        self.__device_rooms = {}
+
+        # aggregates of the current window by (device id, name, labels) as
+        # [min, max, integral, count, last value, last change, first seen],
+        # and the families of the last completed window
+        self.__window = float(args.aggregate_window)
+        self.__window_values = {}
+        self.__window_families = ()
+
+    @property
+    def access_point(self):
+        """
+        the id of the access point of the home
+        """
+        return self.__access_point
+
+    async def wait_connected(self):
+        """
+        waits until the initial sync succeeded and events are enabled
+        """
+        await self.__connected.wait()
+
+    async def __process_raw_message(self, message):
+        if isinstance(message, str):
+            # the byte length equals the character count for ASCII, which
+            # avoids encoding every frame just to measure it
+            size = len(message) if message.isascii() else len(message.encode())
+        else:
+            size = len(message)
+        self.__event_byte_counter.inc(size)
+        self.__last_event = time.monotonic()
+        self.__last_event_timestamp.set_to_current_time()
+        if self.__record_lines is not None:
+            self.__record(message)
+
+        try:
+            events = json.loads(message)["events"]
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning("Ignoring malformed WebSocket message: %s", e)
+            COLLECTION_ERRORS.labels(self.__access_point, "event", "").inc()
+            return
+        self.__process_event(events.values())
+
+    def __record(self, message):
+        """
+        queues a raw WebSocket message for --record-dir
+
+        Every message is written as one line of the Unix time it was received
+        and the message. Newlines in JSON are whitespace, so replacing them
+        keeps the message intact.
+
+        :param message: the raw message
+        """
+        if isinstance(message, bytes):
+            message = message.decode(errors="replace")
+        self.__record_lines.append(
+            "{:.3f} {}\n".format(time.time(), message.replace("\n", " "))
+        )
+        self.__record_pending.set()
+
+    async def __write_records(self):
+        """
+        appends the queued messages to --record-dir until cancelled
+
+        The file is opened, written and closed in a thread, so a slow disk
+        doesn't hold up the events. Messages queued while the file is opened
+        or a batch is written go into the next one, the rest is written when
+        cancelled.
+        """
+        recorder = None
+        write = asyncio.ensure_future(
+            asyncio.to_thread(self.__open_records, self.__record_file)
+        )
+        try:
+            # shielded, a file being opened or written is closed when cancelled
+            recorder = await asyncio.shield(write)
+            while True:
+                await self.__record_pending.wait()
+                self.__record_pending.clear()
+                lines, self.__record_lines = self.__record_lines, []
+                write = asyncio.ensure_future(
+                    asyncio.to_thread(self.__write_lines, recorder, lines)
+                )
+                await asyncio.shield(write)
+        except OSError as e:
+            logging.warning("Recording to {} failed: {}".format(self.__record_file, e))
+        finally:
+            lines, self.__record_lines = self.__record_lines, None
+            await asyncio.wait([write])
+            if recorder is None and write.exception() is None:
+                recorder = write.result()
+            if recorder is not None:
+                try:
+                    await asyncio.to_thread(self.__close_records, recorder, lines)
+                except OSError as e:
+                    logging.warning(
+                        "Recording to {} failed: {}".format(self.__record_file, e)
+                    )
+
+    @staticmethod
+    def __open_records(path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        return open(path, "a", encoding="utf-8")
+
+    @staticmethod
+    def __write_lines(recorder, lines):
+        recorder.writelines(lines)
+        # on disk once written, a crash loses no more than the pending batch
+        recorder.flush()
+
+    @staticmethod
+    def __close_records(recorder, lines):
+        try:
+            recorder.writelines(lines)
+        finally:
+            recorder.close()
+
+    async def start(self):
+        """
+        connects to the home and keeps its state up to date
+
+        Initialization is retried with backoff, so a home that can't be
+        reached doesn't affect the other homes served by the process. If one
+        of the tasks of the home fails, the others are cancelled and the
+        WebSocket is closed before the error is raised, so start can be
+        called again.
+        """
+        if self.__state_file:
+            # referenced so the task isn't garbage collected
+            self.__saver = asyncio.create_task(self.__save_periodically())
+        if self.__record_file:
+            # queued from now on, the file is opened by the task
+            self.__record_lines = []
+            self.__recorder = asyncio.create_task(self.__write_records())
+        if self.__home_client is None:
+            self.__home_client = HomeClient()
+
+        try:
+            failures = 0
+            while True:
+                try:
+                    await self.__home_client.init_async(
+                        self.__config.access_point, self.__config.auth_token
+                    )
+                    await self.__sync(priority="initial")
+                    await self.__save_snapshot()
+                    await self.__enable_events()
+                    break
+                except Exception as e:
+                    failures += 1
+                    delay = min(
+                        SYNC_RETRY_DELAY * 2 ** (failures - 1),
+                        self.__rest_sync_max_interval,
+                    ) * random.uniform(0.5, 1.0)
+                    logging.error(
+                        "Initializing HomematicIP client for {} failed with: {}, "
+                        "retrying in {:.0f}s".format(self.__access_point, e, delay)
+                    )
+                    await asyncio.sleep(delay)
+
+            self.__up.set(1)
+            self.__connected.set()
+            async with asyncio.TaskGroup() as tasks:
+                tasks.create_task(self.__periodic_collection())
+                tasks.create_task(self.__supervise_websocket())
+                if self.__window:
+                    tasks.create_task(self.__roll_windows())
+                if self.__writer is not None:
+                    tasks.create_task(self.__refresh_pushed())
+        finally:
+            self.__up.set(0)
+            if self.__saver is not None:
+                self.__saver.cancel()
+                self.__saver = None
+            if self.__recorder is not None:
+                # waits until the queued messages are written and the file
+                # is closed
+                self.__recorder.cancel()
+                await asyncio.wait([self.__recorder])
+                self.__recorder = None
+                self.__record_lines = None
+            try:
+                await self.__home_client.disable_events_async()
+            except Exception as e:
+                logging.warning(
+                    "Closing WebSocket of {} failed: {}".format(self.__access_point, e)
+                )
+            self.__websocket_connected.set(0)
+            self.__websocket_lost = False
+
+    def __load_snapshot(self):
+        """
+        serves the snapshot saved in --state-dir until the first REST sync
+        """
+        if not self.__state_file:
+            return
+        try:
+            with open(self.__state_file, "rb") as f:
+                data = marshal.load(f)
+            version, access_point, synced_at, groups, home, devices = data
+            if version != SNAPSHOT_FORMAT or access_point != self.__access_point:
+                raise ValueError("format {} of {}".format(version, access_point))
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.warning("Ignoring snapshot {}: {!r}".format(self.__state_file, e))
+            return
+
+        self.__snapshot = self.__saved_snapshot = Snapshot(groups, home, devices)
+        self.__last_sync_timestamp.set(synced_at)
+        self.__stale.set(1)
+        logging.info(
+            "Serving {} devices of {} from the snapshot of {} until connected".format(
+                len(devices),
+                self.__access_point,
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(synced_at)),
+            )
+        )
+
+    async def __save_snapshot(self):
+        """
+        writes the current snapshot to --state-dir if it changed
+        """
+        snapshot = self.__snapshot
+        if (
+            not self.__state_file
+            or snapshot is self.__saved_snapshot
+            or self.__last_sync_time is None
+        ):
+            return
+        data = (SNAPSHOT_FORMAT, self.__access_point, self.__last_sync_time) + tuple(
+            snapshot
+        )
+        try:
+            await asyncio.to_thread(self.__write_snapshot, self.__state_file, data)
+        except (OSError, ValueError) as e:
+            logging.warning(
+                "Saving snapshot {} failed: {}".format(self.__state_file, e)
+            )
+            return
+        self.__saved_snapshot = snapshot
+
+    @staticmethod
+    def __write_snapshot(path, data):
+        # replaced atomically, a crash never leaves a truncated snapshot
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            marshal.dump(data, f)
+        os.replace(tmp, path)
+
+    async def __save_periodically(self):
+        while True:
+            await asyncio.sleep(self.__state_save_interval)
+            await self.__save_snapshot()
+
+    @staticmethod
+    def __event_labels(event):
+        """
+        extracts the id, label and type of the object an event refers to
+
+        :param event: a raw WebSocket event
+        :return: a tuple of (id, label, type)
+        """
+        for key, type_key in (
+            ("device", "modelType"),
+            ("group", "type"),
+            ("client", None),
+            ("home", None),
+        ):
+            data = event.get(key)
+            if data:
+                return (
+                    data.get("id", ""),
+                    data.get("label", ""),
+                    data.get(type_key, "") if type_key else "",
+                )
+        return event.get("id", ""), "", ""
+
+    def __process_event(self, event_list):
+        """
+        applies raw WebSocket events to the snapshot
+
+        Only the fields the exporter exposes are extracted from the payload, and
+        the snapshot is only replaced if one of them actually changed. The
+        published dicts are copied at most once per message, on the first
+        change to them.
+
+        :param event_list: the events of a WebSocket message as parsed JSON
+        """
+        published = self.__snapshot
+        groups, home_samples, device_samples = published
+        # devices whose series may have changed, pushed to the writer
+        changed = set()
+        modified = False
+
+        for event in event_list:
+            try:
+                event_type = event["pushEventType"]
+                logging.debug("EventType: %s", event_type)
+
+                _id, _label, _type = self.__event_labels(event)
+                self.__event_counter.inc(event_type, _id, _label, _type)
+
+                if event_type in ("DEVICE_ADDED", "DEVICE_CHANGED"):
+                    js = event["device"]
+                    samples = self.__build_device_samples(js)
+                    if device_samples.get(js["id"]) != samples:
+                        if device_samples is published.device_samples:
+                            # copy on write, the published dict is never touched
+                            device_samples = dict(device_samples)
+                        device_samples[js["id"]] = samples
+                        changed.add(js["id"])
+                        modified = True
+                elif event_type == "DEVICE_REMOVED":
+                    if event["id"] in device_samples:
+                        if device_samples is published.device_samples:
+                            device_samples = dict(device_samples)
+                        del device_samples[event["id"]]
+                        changed.add(event["id"])
+                        modified = True
+                elif event_type in ("GROUP_ADDED", "GROUP_CHANGED"):
+                    js = event["group"]
+                    room = self.__build_room(js)
+                    if js["type"] == "META" and groups.get(js["id"]) != room:
+                        if groups is published.groups:
+                            groups = dict(groups)
+                        changed.update(groups.get(js["id"], ("", ()))[1])
+                        changed.update(room[1])
+                        groups[js["id"]] = room
+                        modified = True
+                elif event_type == "GROUP_REMOVED":
+                    if event["id"] in groups:
+                        if groups is published.groups:
+                            groups = dict(groups)
+                        changed.update(groups.pop(event["id"])[1])
+                        modified = True
+                elif event_type == "HOME_CHANGED":
+                    samples = self.__build_home_samples(event["home"])
+                    if samples != home_samples:
+                        home_samples = samples
+                        modified = True
+            except Exception as e:
+                logging.warning("Updating snapshot from event failed: %s", e)
+                COLLECTION_ERRORS.labels(
+                    self.__access_point,
+                    "event",
+                    self.__device_type(event.get("device")),
+                ).inc()
+
+        if modified:
+            snapshot = Snapshot(groups, home_samples, device_samples)
+            self.__snapshot = snapshot
+            if self.__writer is not None:
+                self.__push_changes(published, snapshot, changed)
+            self.__observe(changed)
+
+    def __rooms_of_devices(self, groups):
+        """
+        maps every device to the labels of the rooms it is in
+
+        :param groups: the groups of a snapshot
+        :return: a dict of device id to a tuple of room labels
+        """
+        if groups is not self.__device_rooms_groups:
+            device_rooms = collections.defaultdict(tuple)
+            for room, device_ids in groups.values():
+                for device_id in device_ids:
+                    device_rooms[device_id] += (room,)
+            self.__device_rooms = dict(device_rooms)
+            self.__device_rooms_groups = groups
+        return self.__device_rooms
+
+    def __series(self, snapshot, device_ids):
+        """
+        the home series and those of the given devices as served on scrape
+
+        :param snapshot: the Snapshot to read
+        :param device_ids: the ids of the devices to include
+        :return: a dict of (metric name, label values) to value
+        """
+        home = (self.__access_point,)
+        series = {
+            (name, home + labels): value
+            for name, labels, value in snapshot.home_samples
+        }
+        device_rooms = self.__rooms_of_devices(snapshot.groups)
+        for device_id in device_ids:
+            samples = snapshot.device_samples.get(device_id, ())
+            for room in device_rooms.get(device_id, ()):
+                prefix = (self.__access_point, room)
+                for name, labels, value in samples:
+                    series[(name, prefix + labels)] = value
+        return series
+
+    def __push_changes(self, published, snapshot, changed):
+        """
+        hands the series changed by events or REST syncs to the writer
+
+        Series that disappeared are pushed as stale, so they end right away
+        instead of after the lookback window of the receiver.
+
+        :param published: the Snapshot before the events
+        :param snapshot: the Snapshot after the events
+        :param changed: the ids of the devices that may have changed
+        """
+        timestamp = int(time.time() * 1000)
+        before = self.__series(published, changed)
+        after = self.__series(snapshot, changed)
+        for key, value in after.items():
+            if before.get(key) != value:
+                self.__writer.add(key, value, timestamp)
+        for key in before.keys() - after.keys():
+            self.__writer.add(key, None, timestamp)
+
+    async def __refresh_pushed(self):
+        """
+        pushes the current value of every series every PUSH_REFRESH_INTERVAL
+
+        Series are pushed when they change, a value that stays the same, like
+        that of a closed window, would drop out of the lookback of the
+        receiver otherwise. The devices are spread over the interval, so a
+        large home doesn't flood the writer.
+        """
+        while True:
+            device_ids = sorted(self.__snapshot.device_samples)
+            for step in range(PUSH_REFRESH_STEPS):
+                await asyncio.sleep(PUSH_REFRESH_INTERVAL / PUSH_REFRESH_STEPS)
+                timestamp = int(time.time() * 1000)
+                series = self.__series(
+                    self.__snapshot, device_ids[step::PUSH_REFRESH_STEPS]
+                )
+                for key, value in series.items():
+                    self.__writer.add(key, value, timestamp)
+
+    def __observe(self, device_ids=None):
+        """
+        adds the current values of window families to the window aggregates
+
+        :param device_ids: the ids of the devices whose values may have
+            changed, None for all devices
+        """
+        if not self.__window:
+            return
+        now = time.monotonic()
+        device_samples = self.__snapshot.device_samples
+        if device_ids is None:
+            device_ids = device_samples.keys()
+        values = self.__window_values
+        for device_id in device_ids:
+            for name, labels, value in device_samples.get(device_id, ()):
+                if name not in WINDOW_METRIC_FAMILIES:
+                    continue
+                key = (device_id, name, labels)
+                aggregate = values.get(key)
+                if aggregate is None:
+                    values[key] = [value, value, 0.0, 1, value, now, now]
+                elif value != aggregate[4]:
+                    aggregate[0] = min(aggregate[0], value)
+                    aggregate[1] = max(aggregate[1], value)
+                    aggregate[2] += aggregate[4] * (now - aggregate[5])
+                    aggregate[3] += 1
+                    aggregate[4] = value
+                    aggregate[5] = now
+
+    async def __roll_windows(self):
+        """
+        completes the window every --aggregate-window seconds
+
+        The aggregates of the completed window are served until the next one
+        completes, so a scrape interval up to the window length sees every
+        value. The next window starts with the current values.
+        """
+        while True:
+            await asyncio.sleep(self.__window)
+            self.__complete_window()
+
+    def __complete_window(self):
+        """
+        serves the aggregates of the current window and starts the next one
+        """
+        now = time.monotonic()
+        values, self.__window_values = self.__window_values, {}
+        self.__observe()
+        self.__window_families = self.__build_window_families(
+            values, now, self.__rooms_of_devices(self.__snapshot.groups)
+        )
+
+    def __build_window_families(self, values, end, device_rooms):
+        """
+        turns the aggregates of a completed window into metric families
+
+        :param values: the aggregates of the window
+        :param end: the monotonic time the window ended
+        :param device_rooms: the room labels of every device
+        :return: a tuple of GaugeMetricFamily
+        """
+        families = {}
+        for name, documentation, labels in METRIC_FAMILIES:
+            if name in WINDOW_METRIC_FAMILIES:
+                families[name] = [
+                    GaugeMetricFamily(
+                        name + suffix,
+                        "{}, {} over the last --aggregate-window".format(
+                            documentation, aggregate
+                        ),
+                        labels=HOME_LABELNAMES + labels,
+                    )
+                    for suffix, aggregate in WINDOW_AGGREGATES
+                ]
+        for (device_id, name, labels), aggregate in values.items():
+            low, high, integral, count, last, changed, first = aggregate
+            duration = end - first
+            integral += last * (end - changed)
+            stats = (low, high, integral / duration if duration > 0 else last, count)
+            for room in device_rooms.get(device_id, ()):
+                sample_labels = (self.__access_point, room) + labels
+                for family, value in zip(families[name], stats):
+                    family.add_metric(sample_labels, value)
+        return tuple(
+            family for aggregates in families.values() for family in aggregates
+        )
+
+    async def __sync(self, device_ids=None, priority="routine"):
+        """
+        downloads the current state via REST and applies it to the snapshot
+
+        :param device_ids: only re-apply these devices, None for a full sync
+        :param priority: the priority in SYNC_PRIORITIES for the budget
+        """
+        from homematicip.exceptions.connection_exceptions import HmipThrottlingError
+
+        if self.__budget is not None:
+            await self.__budget.acquire(priority, self.__access_point)
+        REST_CALLS.labels(self.__access_point, priority).inc()
+        scope = "full" if device_ids is None else "targeted"
+        with SYNC_DURATION.labels(self.__access_point, scope).time():
+            try:
+                json_state = await self.__home_client.download_configuration_async()
+            except HmipThrottlingError:
+                # the other homes of the account likely share the limit
+                if self.__budget is not None:
+                    self.__budget.drain()
+                raise
+            published = self.__snapshot
+            if device_ids is None or not self.__apply_devices(json_state, device_ids):
+                self.__rebuild_snapshot(json_state)
+                self.__last_full_sync = time.monotonic()
+                device_ids = None
+        if self.__writer is not None:
+            # corrects the series of events that were missed
+            changed = device_ids
+            if changed is None:
+                changed = (
+                    published.device_samples.keys()
+                    | self.__snapshot.device_samples.keys()
+                )
+            self.__push_changes(published, self.__snapshot, changed)
+        self.__observe(device_ids)
+        self.__last_sync_time = time.time()
+        self.__last_sync_timestamp.set(self.__last_sync_time)
+        self.__stale.set(0)
+
+    def __apply_devices(self, json_state, device_ids):
+        """
+        re-applies the given devices and the home from a downloaded state
+
+        :param json_state: the current state as returned by the REST API
+        :param device_ids: the ids of the devices to re-apply
+        :return: False if rooms or devices were added or removed since the last
+            full sync, which requires a full sync
+        """
+        published = self.__snapshot
+        groups = {
+            group_id: self.__build_room(js)
+            for group_id, js in json_state["groups"].items()
+            if js["type"] == "META"
+        }
+        # compared with the last full sync rather than the snapshot, which
+        # lacks the devices that could not be collected
+        if (
+            groups != published.groups
+            or json_state["devices"].keys() != self.__full_sync_devices
+            or not all(device_id in json_state["devices"] for device_id in device_ids)
+        ):
+            return False
+
+        device_samples = dict(published.device_samples)
+        for device_id in device_ids:
+            js = json_state["devices"][device_id]
+            try:
+                device_samples[device_id] = self.__build_device_samples(js)
+            except Exception as e:
+                logging.warning("Collecting device {} failed: {}".format(device_id, e))
+                COLLECTION_ERRORS.labels(
+                    self.__access_point, "rest", self.__device_type(js)
+                ).inc()
+        self.__snapshot = Snapshot(
+            published.groups,
+            self.__build_home_samples(json_state["home"]),
+            device_samples,
+        )
+        return True
+
+    def __stale_devices(self):
+        """
+        finds the devices whose state might be outdated
+
+        :return: the ids of unreachable devices and of devices without a status
+            update within --stale-device-age
+        """
+        oldest = time.time() - self.__stale_device_age
+        stale = []
+        for device_id, samples in self.__snapshot.device_samples.items():
+            for name, labels, value in samples:
+                if (name == "hmip_unreachable" and value) or (
+                    name == "hmip_last_status_update" and value < oldest
+                ):
+                    stale.append(device_id)
+                    break
+        return stale
+
+    def __sync_scope(self, full):
+        """
+        decides which devices the next REST sync has to re-apply
+
+        :param full: whether a full sync was requested
+        :return: the ids of the devices to re-apply or None for a full sync
+        """
+        if (
+            full
+            or not self.__websocket_healthy()
+            or time.monotonic() - self.__last_full_sync >= self.__rest_sync_max_interval
+        ):
+            return None
+
+        stale = self.__stale_devices()
+        if len(stale) > len(self.__snapshot.device_samples) * FULL_SYNC_STALE_RATIO:
+            return None
+        return stale
+
+    async def __enable_events(self):
+        """
+        subscribes to the WebSocket of the home
+        """
+        await self.__home_client.enable_events(
+            additional_message_handler=self.__process_raw_message
+        )
+        self.__home_client.set_on_connected_handler(self.__on_websocket_connected)
+        # a connection closed by the server is reconnected without calling the
+        # reconnect handler, the disconnected handler is called in any case
+        self.__home_client.set_on_disconnected_handler(self.__on_websocket_lost)
+        self.__home_client.set_on_reconnect_handler(self.__on_websocket_lost)
+
+    def __on_websocket_lost(self, reason=None):
+        if not self.__websocket_lost:
+            self.__websocket_lost = True
+            self.__websocket_connected.set(0)
+
+    def __on_websocket_connected(self):
+        self.__websocket_connected.set(1)
+        if self.__websocket_lost:
+            # events sent while disconnected are lost, catch up via REST
+            logging.info(
+                "WebSocket of {} reconnected, requesting REST sync".format(
+                    self.__access_point
+                )
+            )
+            self.__websocket_lost = False
+            WEBSOCKET_RECONNECTS.labels(self.__access_point).inc()
+            self.__resync_requested.set()
+
+    async def __supervise_websocket(self):
+        """
+        restarts the WebSocket subscription when it stalls
+
+        The subscription is restarted when no message arrived within
+        --event-gap-timeout, or when the connection stayed down longer than
+        the restart delay. The reconnect then triggers a catch-up sync.
+        """
+        delay = wait = WEBSOCKET_RESTART_DELAY
+        disconnected_since = None
+        restarted = time.monotonic()
+
+        while True:
+            await asyncio.sleep(WEBSOCKET_CHECK_INTERVAL)
+            now = time.monotonic()
+            if self.__home_client.websocket_is_connected():
+                disconnected_since = None
+                delay = wait = WEBSOCKET_RESTART_DELAY
+                idle = now - max(self.__last_event, restarted)
+                if idle < self.__event_gap_timeout:
+                    continue
+                reason = "idle"
+            else:
+                if disconnected_since is None:
+                    disconnected_since = now
+                if now - disconnected_since < wait:
+                    continue
+                reason = "disconnected"
+                delay = min(delay * 2, WEBSOCKET_MAX_RESTART_DELAY)
+
+            logging.warning(
+                "Restarting WebSocket of {} ({})".format(self.__access_point, reason)
+            )
+            WEBSOCKET_RESTARTS.labels(self.__access_point, reason).inc()
+            self.__on_websocket_lost()
+            try:
+                await self.__home_client.disable_events_async()
+                await self.__enable_events()
+            except Exception as e:
+                logging.warning(
+                    "Restarting WebSocket of {} failed: {}".format(
+                        self.__access_point, e
+                    )
+                )
+            restarted = time.monotonic()
+            disconnected_since = None
+            wait = delay * random.uniform(0.5, 1.0)
+
+    def __websocket_healthy(self):
+        return (
+            self.__home_client.websocket_is_connected()
+            and time.monotonic() - self.__last_event < self.__event_gap_timeout
+        )
+
+    async def __wait_for_sync(self, delay):
+        """
+        waits until the next REST sync is due
+
+        :param delay: the regular delay in seconds
+        :return: the reason for the sync
+        """
+        try:
+            await asyncio.wait_for(self.__resync_requested.wait(), delay)
+        except asyncio.TimeoutError:
+            return "interval"
+        self.__resync_requested.clear()
+        return "reconnect"
+
+    async def __periodic_collection(self):
+        """
+        resyncs the state via REST on an adaptive schedule
+
+        While the WebSocket delivers events the interval doubles up to
+        --rest-sync-max-interval, it drops back to --rest-sync-interval as soon
+        as the connection looks unhealthy. A reconnect, including the one the
+        supervisor forces after a gap in the events, triggers an immediate
+        sync, failures are retried with jittered backoff.
+        """
+        from homematicip.exceptions.connection_exceptions import HmipThrottlingError
+
+        interval = self.__rest_sync_interval
+        failures = 0
+        retry_delay = SYNC_RETRY_DELAY
+        full = False
+
+        while True:
+            if failures:
+                delay = min(
+                    retry_delay * 2 ** (failures - 1), self.__rest_sync_max_interval
+                ) * random.uniform(0.5, 1.0)
+            else:
+                delay = interval
+            reason = await self.__wait_for_sync(delay)
+            if reason != "interval":
+                # events may have been missed, so anything can be outdated
+                full = True
+
+            device_ids = self.__sync_scope(full)
+            if device_ids is None:
+                logging.debug("Starting full REST sync ({})".format(reason))
+            elif device_ids:
+                logging.debug(
+                    "Starting REST sync of {} stale devices ({})".format(
+                        len(device_ids), reason
+                    )
+                )
+            try:
+                # nothing to do if the WebSocket is healthy and no device is stale
+                if device_ids != []:
+                    await self.__sync(device_ids, "catch_up" if full else "routine")
+            except HmipThrottlingError:
+                failures += 1
+                retry_delay = SYNC_THROTTLED_RETRY_DELAY
+                # the state stays outdated until the retry, so it catches up
+                full = full or device_ids is None
+                logging.warning(
+                    "Periodic collection of {} was throttled by the cloud".format(
+                        self.__access_point
+                    )
+                )
+                SYNC_FAILURES.labels(self.__access_point, "throttled").inc()
+                continue
+            except Exception as e:
+                failures += 1
+                retry_delay = SYNC_RETRY_DELAY
+                full = full or device_ids is None
+                logging.warning(
+                    "Periodic collection of {} failed: {}".format(
+                        self.__access_point, e
+                    )
+                )
+                SYNC_FAILURES.labels(self.__access_point, "error").inc()
+                continue
+
+            failures = 0
+            full = False
+            if reason == "interval" and self.__websocket_healthy():
+                interval = min(interval * 2, self.__rest_sync_max_interval)
+            else:
+                interval = self.__rest_sync_interval
+
+    def __rebuild_snapshot(self, json_state):
+        """
+        rebuilds the samples of the home and of all devices
+
+        :param json_state: the current state as returned by the REST API
+        """
+        groups = {
+            group_id: self.__build_room(js)
+            for group_id, js in json_state["groups"].items()
+            if js["type"] == "META"
+        }
+        device_samples = {}
+        for device_id, js in json_state["devices"].items():
+            try:
+                device_samples[device_id] = self.__build_device_samples(js)
+            except Exception as e:
+                logging.warning("Collecting device {} failed: {}".format(device_id, e))
+                COLLECTION_ERRORS.labels(
+                    self.__access_point, "rest", self.__device_type(js)
+                ).inc()
+
+        self.__snapshot = Snapshot(
+            groups, self.__build_home_samples(json_state["home"]), device_samples
+        )
+        self.__full_sync_devices = frozenset(json_state["devices"])
+
+        # drop the event series of removed and renamed objects
+        live = {
+            _id: js.get("label", "")
+            for section in ("devices", "groups", "clients")
+            for _id, js in json_state.get(section, {}).items()
+        }
+        live[json_state["home"]["id"]] = ""
+        self.__event_counter.prune(live)
+
+    @staticmethod
+    def __device_type(js):
+        """
+        the device type label of hmip_collection_errors_total
+
+        :param js: the device as returned by the REST API, may be None
+        :return: the lower case device type or an empty string
+        """
+        if not isinstance(js, dict):
+            return ""
+        return str(js.get("type", "")).lower()
+
+    @staticmethod
+    def __build_room(js):
+        """
+        builds the room of a META group
+
+        :param js: the group as returned by the REST API
+        :return: a tuple of (label, device ids)
+        """
+        return js["label"], tuple(dict.fromkeys(c["deviceId"] for c in js["channels"]))
+
+    @staticmethod
+    def __build_home_samples(js):
+        """
+        builds the samples for the access point and the weather
+
+        :param js: the home as returned by the REST API
+        :return: a tuple of (metric name, label values, value)
+        """
+        samples = []
+
+        # Weather Info
+        w = js.get("weather")
+        if w:
+            city = (js.get("location") or {}).get("city", "")
+            for name, key in (
+                ("hmip_weather_temperature", "temperature"),
+                ("hmip_weather_humidity", "humidity"),
+                ("hmip_weather_vapor_amount", "vaporAmount"),
+                ("hmip_weather_wind_speed", "windSpeed"),
+                ("hmip_weather_min_temperature", "minTemperature"),
+                ("hmip_weather_max_temperature", "maxTemperature"),
+            ):
+                value = w.get(key)
+                if value:
+                    samples.append((name, (city,), value))
+
+        # Version Info
+        if js.get("currentAPVersion"):
+            samples.append(("hmip_version_info", (js["currentAPVersion"],), 1))
+
+        # Duty Cycle Info
+        if js.get("dutyCycle"):
+            samples.append(("hmip_duty_cycle", (), js["dutyCycle"]))
+
+        return tuple(samples)
+
+    @staticmethod
+    def __build_device_samples(js):
+        """
+        builds the samples for a single device
+
+        The room label is not part of the samples, it is prepended when the
+        metric families are built so that room changes don't touch devices.
+
+        :param js: the device as returned by the REST API or a WebSocket event
+        :return: a tuple of (metric name, label values without room, value)
+        """
+        labels = (js["label"],)
+        channels = js["functionalChannels"]
+        base = channels.get("0") or {}
+        features = base.get("supportedOptionalFeatures") or {}
+        samples = []
+
+        # Device Info
+        samples.append(
+            (
+                "hmip_device_info",
+                labels
+                + (
+                    js["type"].lower(),
+                    js["firmwareVersion"],
+                    str(js["permanentlyReachable"]),
+                    js["id"],
+                    js["modelType"],
+                    js["connectionType"],
+                ),
+                1,
+            )
+        )
+        if js.get("lastStatusUpdate", 0) > 0:
+            samples.append(
+                ("hmip_last_status_update", labels, js["lastStatusUpdate"] / 1000.0)
+            )
+
+        for channel_types, per_channel, fields in device_rules(js["type"]):
+            if channel_types is BASE_CHANNEL:
+                selected = (base,)
+            else:
+                selected = [
+                    c
+                    for c in channels.values()
+                    if c["functionalChannelType"] in channel_types
+                ]
+                if not per_channel:
+                    selected = selected[:1]
+
+            for c in selected:
+                if per_channel:
+                    sample_labels = labels + (str(c["index"]), c["label"])
+                else:
+                    sample_labels = labels
+                for metric, key, convert, keep, default, feature in fields:
+                    if feature and not features.get(feature):
+                        continue
+                    v = c.get(key, default)
+                    if keep(v):
+                        samples.append((metric, sample_labels, convert(v)))
+
+        return tuple(samples)
+
+    @staticmethod
+    def __build_families(snapshot, access_point):
+        """
+        turns a snapshot into metric families
+
+        :param snapshot: the Snapshot to expose
+        :param access_point: the access point label of all series
+        :return: a tuple of GaugeMetricFamily in exposition order
+        """
+        families = {
+            name: GaugeMetricFamily(
+                name, documentation, labels=HOME_LABELNAMES + labels
+            )
+            for name, documentation, labels in METRIC_FAMILIES
+        }
+        home = (access_point,)
+        for name, labels, value in snapshot.home_samples:
+            families[name].add_metric(home + labels, value)
+        for room, device_ids in snapshot.groups.values():
+            prefix = (access_point, room)
+            for device_id in device_ids:
+                for name, labels, value in snapshot.device_samples.get(device_id, ()):
+                    families[name].add_metric(prefix + labels, value)
+
+        return tuple(
+            family
+            for family in families.values()
+            if family.samples or family.name not in OPTIONAL_METRIC_FAMILIES
+        )
+
+    def collect(self):
+        """
+        collect serves the metric families of the current snapshot
+        """
+        # a single read of the published reference gives a consistent view,
+        # the lock only serializes concurrent scrapes building the families
+        snapshot = self.__snapshot
+        with self.__families_lock:
+            if self.__families_snapshot is not snapshot:
+                self.__families = self.__build_families(snapshot, self.__access_point)
+                self.__families_snapshot = snapshot
+            families = self.__families
+        yield from families
+        yield from self.__window_families
+        yield from self.__event_counter.collect()
+
+
+class MultiHomeCollector(object):
+    """
+    Serves the metrics of several homes as one set of metric families
+
+    Every home is collected by its own HomematicIPCollector, the families
+    of equal name are merged on scrape. The cached families of the homes
+    are never modified.
     """
 
-    def __init__(self, args):
+    def __init__(self, homes):
         """
-        initializes the exporter
+        initializes the collector
 
-        :param args: the argparse.Args
+        :param homes: the HomematicIPCollector of every home
         """
+        self.__homes = tuple(homes)
+        # merged families by name as (families of the homes, merged family)
+        self.__merged = {}
 
-        self.__home_client = None
-        self.__metric_port = int(args.metric_port)
-        self.__log_level = int(args.log_level)
-        self.__rest_sync_interval = int(args.rest_sync_interval)
-        self.__config = None
+    @property
+    def homes(self):
+        return self.__homes
 
-        logging.info(
-            "using config file '{}' and exposing metrics on port '{}'".format(
-                args.config_file, self.__metric_port
-            )
+    def collect(self):
+        start = time.perf_counter()
+        families = {}
+        for home in self.__homes:
+            for family in home.collect():
+                families.setdefault(family.name, []).append(family)
+
+        # merged families are kept while the homes serve the same families,
+        # so the exposition of an unchanged family can be reused
+        merged = {}
+        for name, parts in families.items():
+            if len(parts) == 1:
+                families[name] = parts[0]
+                continue
+            parts = tuple(parts)
+            cached = self.__merged.get(name)
+            if (
+                cached is None
+                or len(cached[0]) != len(parts)
+                or any(a is not b for a, b in zip(cached[0], parts))
+            ):
+                # the families are cached by their homes, merge into a copy
+                combined = Metric(name, parts[0].documentation, parts[0].type)
+                combined.samples = [s for family in parts for s in family.samples]
+                cached = (parts, combined)
+            merged[name] = cached
+            families[name] = cached[1]
+        self.__merged = merged
+
+        family_samples = GaugeMetricFamily(
+            "hmip_exporter_family_samples",
+            "Number of samples per metric family of the last scrape",
+            labels=["family"],
         )
+        for family in families.values():
+            family_samples.add_metric([family.name], len(family.samples))
+        COLLECT_DURATION.observe(time.perf_counter() - start)
+
+        yield from families.values()
+        yield family_samples
+
+
+class EventCounter(object):
+    """
+    Counts WebSocket events per label set with a bounded number of series
+
+    Label sets are interned and kept in least recently used order. Once
+    the limit is reached, events for new label sets are counted in one
+    overflow series per event type. The overflow series count towards the
+    limit, the least recently used series is evicted to make room for them.
+    Series of objects that no longer exist are dropped by prune() after
+    every full sync.
+    """
+
+    def __init__(self, max_series, access_point):
+        """
+        initializes the counter
+
+        :param max_series: the maximum number of series
+        :param access_point: the access point label of all series
+        """
+        self.__max_series = max(max_series, 1)
+        self.__home = (access_point,)
+        self.__series = collections.OrderedDict()
+        self.__evicted = 0
+        self.__lock = threading.Lock()
+
+    def inc(self, event_type, _id, label, _type):
+        key = (event_type, _id, label, _type)
+        with self.__lock:
+            series = self.__series
+            if key not in series and len(series) >= self.__max_series:
+                key = (event_type, EVENT_OVERFLOW_ID, "", "")
+            if key in series:
+                series[key] += 1
+                series.move_to_end(key)
+                return
+            if len(series) >= self.__max_series:
+                series.popitem(last=False)
+                self.__evicted += 1
+            series[tuple(sys.intern(str(v)) for v in key)] = 1
+
+    def prune(self, live):
+        """
+        evicts the series of objects that were removed or renamed
+
+        :param live: the labels of all existing objects by id
+        """
+        with self.__lock:
+            stale = [
+                key
+                for key in self.__series
+                if key[1] and key[1] != EVENT_OVERFLOW_ID and live.get(key[1]) != key[2]
+            ]
+            for key in stale:
+                del self.__series[key]
+            self.__evicted += len(stale)
 
-        self.__load_config(args.config_file, args.auth_token, args.access_point)
-        self.__home_client = AsyncHome()
-        self.__event_counter = Counter(
-            "hmip_websocket_events_count_total",
+    def collect(self):
+        home = self.__home
+        events = CounterMetricFamily(
+            "hmip_websocket_events_count",
             "Number of events received from HomematicIP WebSocket",
-            ["event_type", "id", "label", "type"],
+            labels=HOME_LABELNAMES + ["event_type", "id", "label", "type"],
         )
-        self.__event_byte_counter = Counter(
-            "hmip_websocket_events_bytes_total",
-            "Total bytes received from HomematicIP WebSocket",
+        with self.__lock:
+            for key, value in self.__series.items():
+                events.add_metric(home + key, value)
+            evicted = self.__evicted
+        yield events
+
+        series = GaugeMetricFamily(
+            "hmip_websocket_event_series",
+            "Number of live series of hmip_websocket_events_count_total",
+            labels=HOME_LABELNAMES,
         )
+        series.add_metric(home, len(events.samples))
+        yield series
 
-    def __load_config(self, config_file, auth_token, access_point):
-        if auth_token and access_point:
-            self.__config = homematicip.HmipConfig(
-                auth_token=auth_token,
-                access_point=access_point,
-                log_level=self.__log_level,
-                log_file="hmip.log",
-                raw_config=None,
-            )
+        evicted_series = CounterMetricFamily(
+            "hmip_websocket_event_series_evicted",
+            "Number of series of hmip_websocket_events_count_total evicted, "
+            "because their object was removed or to make room for an overflow "
+            "series",
+            labels=HOME_LABELNAMES,
+        )
+        evicted_series.add_metric(home, evicted)
+        yield evicted_series
+
+
+class SelectedRegistry(object):
+    """
+    View of a registry restricted to a Selection
+
+    Families are kept if their name is selected, otherwise only their
+    samples of a selected name. The room, device and type filters apply to
+    series of devices, recognised by their device_label, and are resolved
+    through hmip_device_info. Other series are kept. Selected families are
+    copies, the families of the collectors are never modified. They are kept
+    while the registry serves the same families, so their exposition can be
+    reused.
+    """
+
+    def __init__(self, registry, selection):
+        """
+        initializes the view
+
+        :param registry: the prometheus_client registry to restrict
+        :param selection: the Selection to apply
+        """
+        self.__registry = registry
+        self.__selection = selection
+        # (hmip_device_info family, keys of the selected devices)
+        self.__devices = (None, None)
+        # selected families by family id as (family, selected devices,
+        # selected family or None)
+        self.__selected = {}
+
+    def collect(self):
+        names, rooms, devices, types = self.__selection
+        families = list(self.__registry.collect())
+        selected_devices = None
+        if rooms or devices or types:
+            info = next((f for f in families if f.name == "hmip_device_info"), None)
+            if self.__devices[0] is not info or self.__devices[1] is None:
+                self.__devices = (info, self.__select_devices(info))
+            selected_devices = self.__devices[1]
+
+        selected = {}
+        for family in families:
+            cached = self.__selected.get(id(family))
+            if (
+                cached is None
+                or cached[0] is not family
+                or cached[1] is not selected_devices
+            ):
+                cached = (
+                    family,
+                    selected_devices,
+                    self.__select(family, selected_devices),
+                )
+            selected[id(family)] = cached
+            if cached[2] is not None:
+                yield cached[2]
+        self.__selected = selected
+
+    def __select_devices(self, info):
+        """
+        resolves the room, device and type filters
+
+        :param info: the hmip_device_info family, if any
+        :return: a set of the keys of the selected devices
+        """
+        names, rooms, devices, types = self.__selection
+        selected_devices = set()
+        for sample in info.samples if info is not None else ():
+            labels = sample.labels
+            if (
+                (not rooms or labels["room"] in rooms)
+                and (
+                    not devices
+                    or labels["device_label"] in devices
+                    or labels["device_id"] in devices
+                )
+                and (not types or labels["device_type"] in types)
+            ):
+                selected_devices.add(self.__device_key(labels))
+        return selected_devices
+
+    def __select(self, family, selected_devices):
+        """
+        restricts a family to the selection
+
+        :param family: the family to restrict
+        :param selected_devices: the keys of the selected devices, None if
+            devices aren't filtered
+        :return: the family, a restricted copy or None if nothing is selected
+        """
+        names = self.__selection.names
+        if names and family.name not in names:
+            samples = [s for s in family.samples if s.name in names]
+            if not samples:
+                return None
         else:
-            self.__config = homematicip.load_config_file(config_file=config_file)
+            samples = family.samples
+        if selected_devices is not None and samples:
+            kept = [
+                s
+                for s in samples
+                if "device_label" not in s.labels
+                or self.__device_key(s.labels) in selected_devices
+            ]
+            if not kept:
+                return None
+            if len(kept) < len(samples):
+                samples = kept
+        if samples is family.samples:
+            return family
+        selected = Metric(family.name, family.documentation, family.type, family.unit)
+        selected.samples = samples
+        return selected
 
-    async def __process_raw_message(self, message):
-        self.__event_byte_counter.inc(len(str(message)))
+    @staticmethod
+    def __device_key(labels):
+        return labels["access_point"], labels["room"], labels["device_label"]
+
+
+def parse_selection(query):
+    """
+    reads the selection of families and devices from a /metrics query
+
+    Every parameter may be given several times, any of its values matches.
+    name[] selects families or samples by name, room the room labels,
+    device the device labels or ids and type the device types.
+
+    :param query: the query of the request as a multidict
+    :return: a Selection or None if nothing is selected
+    """
+    if not any(parameter in query for parameter in SELECTION_PARAMETERS):
+        return None
+    names, rooms, devices, types = (
+        frozenset(query.getall(parameter, ())) for parameter in SELECTION_PARAMETERS
+    )
+    return Selection(names, rooms, devices, frozenset(t.lower() for t in types))
+
+
+class MetricsServer(object):
+    """
+    Serves a registry on /metrics from the asyncio loop
+
+    Every scrape collects the registry, but the encoded bytes of a family
+    are kept as long as any collector serves the same family object, for
+    the full exposition and all selections like ?name[]=hmip_low_bat. The
+    families of a home are only replaced when its snapshot changes, so a
+    scrape of an unchanged home only encodes the event counters and
+    self-metrics. Gzip members of runs of unchanged families are kept as
+    well, only the families encoded by a scrape are compressed with it.
+    Encoding runs in a worker thread, so a large exposition doesn't hold up
+    the WebSocket events.
+    """
+
+    def __init__(self, registry, port):
+        """
+        initializes the server
+
+        :param registry: the prometheus_client registry to expose
+        :param port: the port to listen on
+        """
+        self.__registry = registry
+        self.__port = port
+        # encoded families by content type, as dicts of family id to (weak
+        # reference to the family, bytes), dropped along with the family
+        self.__encoded = {}
+        # gzip members of the last scrape by (content type, selection), as
+        # lists of (encoded families, member)
+        self.__members = {}
+        self.__selected = {}
+        self.__trailers = {}
+        self.__lock = threading.Lock()
+        self.__runner = None
 
     async def start(self):
-        try:
-            await self.__home_client.init_async(
-                self.__config.access_point, self.__config.auth_token
-            )
-            await self.__home_client.get_current_state_async()
-            self.__home_client.onEvent += self.__process_event
-            await self.__home_client.enable_events(
-                additional_message_handler=self.__process_raw_message
-            )
-            await self.__periodic_collection()
-        except Exception as e:
-            logging.fatal(
-                "Initializing HomematicIP client failed with: {}".format(str(e))
-            )
-            sys.exit(1)
+        app = web.Application()
+        app.router.add_get("/", self.__handle_metrics)
+        app.router.add_get("/metrics", self.__handle_metrics)
+        self.__runner = web.AppRunner(app, access_log=None)
+        await self.__runner.setup()
+        await web.TCPSite(self.__runner, port=self.__port).start()
+        logging.info("Prometheus exporter started on port {}".format(self.__port))
 
-    def __process_event(self, event_list):
-        for event in event_list:
-            logging.info(
-                "EventType: {} Data: {}".format(event["eventType"], event["data"])
-            )
+    async def stop(self):
+        if self.__runner:
+            await self.__runner.cleanup()
+            self.__runner = None
 
-            try:
-                event_type = event["eventType"]
-                obj = event["data"]
-
-                # Extract device info if available
-                _id = ""
-                _label = ""
-                _type = ""
-
-                if hasattr(obj, "id"):
-                    _id = obj.id
-                if hasattr(obj, "label"):
-                    _label = obj.label
-                if hasattr(obj, "modelType"):
-                    _type = obj.modelType
-                elif hasattr(obj, "groupType"):
-                    _type = obj.groupType
-
-                self.__event_counter.labels(
-                    event_type=event_type, id=_id, label=_label, type=_type
-                ).inc()
+    def exposition(self, accept, accept_encoding, selection=None):
+        """
+        returns the encoded exposition for the given request headers
 
-            except Exception as e:
-                logging.error("Error logging event: %s", e)
+        :param accept: the Accept header of the request
+        :param accept_encoding: the Accept-Encoding header of the request
+        :param selection: the Selection to restrict the exposition to, if any
+        :return: a tuple of (body, content type, gzip compressed)
+        """
+        encoder, content_type = choose_encoder(accept)
+        compress = gzip_accepted(accept_encoding)
+        encoding = "gzip" if compress else "identity"
+        with SCRAPE_DURATION.labels(encoding).time(), self.__lock:
+            if len(self.__members) >= EXPOSITION_CACHE_SIZE:
+                self.__members = {}
+            if len(self.__selected) >= EXPOSITION_CACHE_SIZE:
+                self.__selected = {}
+            registry = self.__registry
+            if selection is not None:
+                registry = self.__selected.get(selection)
+                if registry is None:
+                    registry = SelectedRegistry(self.__registry, selection)
+                    self.__selected[selection] = registry
+            trailer = self.__trailers.get(content_type)
+            if trailer is None:
+                # the end of the exposition, "# EOF" for OpenMetrics
+                output = encoder(_Families(()))
+                trailer = self.__trailers[content_type] = (
+                    output,
+                    gzip.compress(output) if output else b"",
+                )
 
-    async def __periodic_collection(self):
-        while True:
-            try:
-                await asyncio.sleep(self.__rest_sync_interval)
-                await self.__home_client.get_current_state_async()
-            except Exception as e:
-                logging.warning("Periodic collection failed: %s", e)
+            encoded = self.__encoded.setdefault(content_type, {})
+            parts = []
+            fresh = set()
+            for family in registry.collect():
+                part = encoded.get(id(family))
+                if part is None or part[0]() is not family:
+                    output = encoder(_Families((family,)))
+                    forget = functools.partial(_forget, encoded, id(family))
+                    part = (
+                        weakref.ref(family, forget),
+                        output[: len(output) - len(trailer[0])],
+                    )
+                    encoded[id(family)] = part
+                    fresh.add(id(part))
+                parts.append(part)
 
-    def collect(self):
+            if not compress:
+                output = b"".join(part[1] for part in parts) + trailer[0]
+                return output, content_type, compress
+            members = self.__compress(parts, fresh, (content_type, selection))
+            return b"".join(members) + trailer[1], content_type, compress
+
+    def __compress(self, parts, fresh, key):
         """
-        collect discovers all devices and generates metrics
+        gzip-compresses the encoded families of a scrape
+
+        Concatenated gzip members are one valid gzip stream. Families encoded
+        before this scrape are compressed in runs of about GZIP_MEMBER_SIZE
+        bytes, the member of a run is reused while it holds the same families.
+
+        :param parts: the encoded families in exposition order
+        :param fresh: the ids of the parts encoded by this scrape
+        :param key: the (content type, selection) of the scrape
+        :return: the gzip members
         """
-        labelnames = ["room", "device_label"]
-        detail_labelnames = [
-            "device_type",
-            "firmware_version",
-            "permanently_reachable",
-            "device_id",
-            "model_type",
-            "connection_type",
-        ]
+        runs = []
+        for part in parts:
+            unchanged = id(part) not in fresh
+            if runs and runs[-1][0] == unchanged and runs[-1][2] < GZIP_MEMBER_SIZE:
+                runs[-1][1].append(part)
+                runs[-1][2] += len(part[1])
+            else:
+                runs.append([unchanged, [part], len(part[1])])
 
-        # Home Metrics
-        version_info = GaugeMetricFamily(
-            "hmip_version_info", "HomematicIP info", labels=["api_version"]
-        )
+        previous = {id(run[0][0]): run for run in self.__members.get(key, ())}
+        members = []
+        cached = []
+        for unchanged, run, _ in runs:
+            if not unchanged:
+                members.append(gzip.compress(b"".join(part[1] for part in run)))
+                continue
+            kept = previous.get(id(run[0]))
+            if (
+                kept is None
+                or len(kept[0]) != len(run)
+                or any(a is not b for a, b in zip(kept[0], run))
+            ):
+                kept = (tuple(run), gzip.compress(b"".join(part[1] for part in run)))
+            cached.append(kept)
+            members.append(kept[1])
+        self.__members[key] = cached
+        return members
 
-        metric_duty_cycle_ratio = GaugeMetricFamily(
-            "hmip_duty_cycle",
-            "The current duty cycle of the access point",
+    async def __handle_metrics(self, request):
+        output, content_type, compress = await asyncio.to_thread(
+            self.exposition,
+            request.headers.get("Accept", ""),
+            request.headers.get("Accept-Encoding", ""),
+            parse_selection(request.query),
         )
+        headers = {"Content-Type": content_type}
+        if compress:
+            headers["Content-Encoding"] = "gzip"
+        return web.Response(body=output, headers=headers)
 
-        metric_weather_temperature = GaugeMetricFamily(
-            "hmip_weather_temperature", "Weather Temperature", labels=["location"]
-        )
-        metric_weather_humidity = GaugeMetricFamily(
-            "hmip_weather_humidity", "Weather Humidity", labels=["location"]
-        )
-        metric_weather_vapor_amount = GaugeMetricFamily(
-            "hmip_weather_vapor_amount", "Weather Vapor Amount", labels=["location"]
-        )
-        metric_wind_speed = GaugeMetricFamily(
-            "hmip_weather_wind_speed", "Wind Speed", labels=["location"]
-        )
-        metric_min_temperature = GaugeMetricFamily(
-            "hmip_weather_min_temperature", "Minimum Temperature", labels=["location"]
-        )
-        metric_max_temperature = GaugeMetricFamily(
-            "hmip_weather_max_temperature", "Maximum Temperature", labels=["location"]
-        )
 
-        # Device Metrics
-        metric_temperature_actual = GaugeMetricFamily(
-            "hmip_current_temperature_celsius", "Actual temperature", labels=labelnames
-        )
-        metric_temperature_setpoint = GaugeMetricFamily(
-            "hmip_set_temperature_celsius", "Set point temperature", labels=labelnames
-        )
-        metric_valve_adaption_needed = GaugeMetricFamily(
-            "hmip_valve_adaption_needed", "must the adaption re-run?", labels=labelnames
-        )
-        metric_temperature_offset = GaugeMetricFamily(
-            "hmip_temperature_offset",
-            "the offset temperature for the thermostat",
-            labels=labelnames,
-        )
-        metric_heating_valve_position = GaugeMetricFamily(
-            "hmip_heating_valve_position",
-            "the current position of the valve 0.0 = closed, 1.0 max opened",
-            labels=labelnames + ["channel", "channel_name"],
-        )
-        metric_humidity_actual = GaugeMetricFamily(
-            "hmip_current_humidity_relative", "Actual Humidity", labels=labelnames
-        )
-        metric_vapor_amount = GaugeMetricFamily(
-            "hmip_vapor_amount", "Vapor Amount", labels=labelnames
-        )
-        metric_low_bat = GaugeMetricFamily(
-            "hmip_low_bat", "Low Battery", labels=labelnames
-        )
-        metric_unreach = GaugeMetricFamily(
-            "hmip_unreachable", "Unreachable", labels=labelnames
-        )
-        metric_config_pending = GaugeMetricFamily(
-            "hmip_config_pending", "Configuration Pending", labels=labelnames
-        )
-        metric_duty_cycle = GaugeMetricFamily(
-            "hmip_duty_cycle_limited", "Duty Cycle Reached", labels=labelnames
-        )
-        metric_last_status_update = GaugeMetricFamily(
-            "hmip_last_status_update", "Device last status update", labels=labelnames
-        )
-        metric_device_info = GaugeMetricFamily(
-            "hmip_device_info",
-            "Device information",
-            labels=labelnames + detail_labelnames,
-        )
+def _forget(encoded, key, ref):
+    # drops the encoded bytes of a family once it is garbage collected
+    part = encoded.get(key)
+    if part is not None and part[0] is ref:
+        encoded.pop(key, None)
 
-        metric_valve_protection_duration = GaugeMetricFamily(
-            "hmip_valve_protection_duration",
-            "Valve Protection Duration",
-            labels=labelnames,
-        )
-        metric_valve_protection_switching_interval = GaugeMetricFamily(
-            "hmip_valve_protection_switching_interval",
-            "Valve Protection Switching Interval",
-            labels=labelnames,
-        )
-        metric_rssi_device_value = GaugeMetricFamily(
-            "hmip_rssi_device_value", "RSSI device value", labels=labelnames
-        )
-        metric_rssi_peer_value = GaugeMetricFamily(
-            "hmip_rssi_peer_value", "RSSI peer value", labels=labelnames
-        )
-        metric_valve_flow_error = GaugeMetricFamily(
-            "hmip_valve_flow_error", "Valve Flow Error", labels=labelnames
-        )
-        metric_valve_water_error = GaugeMetricFamily(
-            "hmip_valve_water_error", "Valve Water Error", labels=labelnames
+
+class _Families(object):
+    # a collector serving the given families, to encode them one by one
+    def __init__(self, families):
+        self.__families = families
+
+    def collect(self):
+        return self.__families
+
+
+class RestBudget(object):
+    """
+    Token bucket limiting the REST syncs of the homes of an account
+
+    A sync takes a token, tokens are regained one per refill interval up to
+    the capacity. Syncs waiting for a token are served by priority, so a
+    catch-up sync of one home goes ahead of routine syncs of the others.
+    Within a priority the home served least recently goes first, so a home
+    syncing often doesn't hold up the others. The initial sync of a home
+    doesn't wait, but its token is owed by the following syncs.
+    """
+
+    def __init__(self, capacity, refill_interval):
+        """
+        initializes the budget
+
+        :param capacity: the number of syncs allowed in a burst
+        :param refill_interval: the seconds after which a token is regained
+        """
+        self.__capacity = capacity
+        self.__refill_interval = refill_interval
+        self.__tokens = float(capacity)
+        self.__updated = time.monotonic()
+        # heap of (priority, last sync of the home, sequence) of the syncs
+        # waiting for a token
+        self.__waiters = []
+        self.__sequence = 0
+        # sequence of the last sync by home
+        self.__served = {}
+        self.__condition = asyncio.Condition()
+
+    def remaining(self):
+        """
+        the number of tokens, including the fraction regained so far
+        """
+        elapsed = time.monotonic() - self.__updated
+        return min(self.__capacity, self.__tokens + elapsed / self.__refill_interval)
+
+    def drain(self):
+        """
+        empties the bucket, the next sync waits a full refill interval
+        """
+        # syncs owed by initial syncs stay owed
+        self.__tokens = min(self.remaining(), 0.0)
+        self.__updated = time.monotonic()
+
+    async def acquire(self, priority, home):
+        """
+        waits for a token
+
+        :param priority: the name of the priority in SYNC_PRIORITIES
+        :param home: the access point of the home syncing
+        """
+        self.__sequence += 1
+        if priority == "initial":
+            self.__tokens = self.remaining() - 1
+            self.__updated = time.monotonic()
+            self.__served[home] = self.__sequence
+            return
+        entry = (SYNC_PRIORITIES[priority], self.__served.get(home, 0), self.__sequence)
+        heapq.heappush(self.__waiters, entry)
+        async with self.__condition:
+            try:
+                while True:
+                    self.__tokens = self.remaining()
+                    self.__updated = time.monotonic()
+                    timeout = None
+                    if self.__waiters[0] == entry:
+                        if self.__tokens >= 1:
+                            self.__tokens -= 1
+                            self.__served[home] = entry[2]
+                            break
+                        timeout = (1 - self.__tokens) * self.__refill_interval
+                    try:
+                        await asyncio.wait_for(self.__condition.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self.__waiters.remove(entry)
+                heapq.heapify(self.__waiters)
+                self.__condition.notify_all()
+
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _field(number, data):
+    # a length-delimited protobuf field
+    return _varint(number << 3 | 2) + _varint(len(data)) + data
+
+
+def encode_write_request(samples):
+    """
+    encodes samples as a Prometheus remote write request
+
+    The protobuf messages are written by hand and the snappy block holds a
+    single literal, which every receiver accepts, so neither a protobuf nor
+    a snappy library is needed. Samples of a series sharing a timestamp are
+    reduced to the last one, receivers reject duplicates.
+
+    :param samples: a list of (label pairs, value, timestamp in milliseconds),
+        a value of None marks the series stale
+    :return: the snappy compressed body
+    """
+    series = {}
+    for labels, value, timestamp in samples:
+        values = series.setdefault(labels, [])
+        if values and values[-1][1] >= timestamp:
+            values[-1] = (value, values[-1][1])
+        else:
+            values.append((value, timestamp))
+
+    request = bytearray()
+    for labels, values in series.items():
+        message = bytearray()
+        for name, value in labels:
+            message += _field(1, _field(1, name.encode()) + _field(2, value.encode()))
+        for value, timestamp in values:
+            encoded = PUSH_STALE_MARKER if value is None else struct.pack("<d", value)
+            message += _field(2, b"\x09" + encoded + b"\x10" + _varint(timestamp))
+        request += _field(1, message)
+    return (
+        _varint(len(request))
+        + b"\xfc"
+        + struct.pack("<I", len(request) - 1)
+        + bytes(request)
+    )
+
+
+class RemoteWriter(object):
+    """
+    Pushes samples to a Prometheus remote write endpoint in batches
+
+    Samples are queued by add() and sent once batch_size of them are
+    pending, or every interval seconds, over a single kept-alive connection.
+    Requests that failed are retried on the next flush. Batches the receiver
+    rejects with a client error other than 429 are dropped, as resending
+    them can't succeed.
+    """
+
+    def __init__(self, url, batch_size, interval):
+        """
+        initializes the writer
+
+        :param url: the remote write endpoint
+        :param batch_size: the number of samples that triggers a flush
+        :param interval: the maximum seconds a sample is held back
+        """
+        self.__url = url
+        self.__batch_size = batch_size
+        self.__interval = interval
+        self.__pending = []
+        self.__flush = asyncio.Event()
+
+    def add(self, key, value, timestamp):
+        """
+        queues a sample
+
+        :param key: a tuple of (metric name, label values in family order)
+        :param value: the value, None marks the series stale
+        :param timestamp: the timestamp in milliseconds
+        """
+        name, label_values = key
+        # receivers expect sorted labels, empty ones are equal to absent ones
+        labels = tuple(
+            sorted(
+                (label, str(v))
+                for label, v in zip(FAMILY_LABELNAMES[name], (name,) + label_values)
+                if v != ""
+            )
         )
-        metric_minimum_floor_heating_valve_position = GaugeMetricFamily(
-            "hmip_minimum_floor_heating_valve_position",
-            "Minimum Floor Heating Valve Position",
-            labels=labelnames,
+        self.__pending.append((labels, value, timestamp))
+        self.__trim()
+        if len(self.__pending) >= self.__batch_size:
+            self.__flush.set()
+
+    def __trim(self):
+        dropped = len(self.__pending) - PUSH_MAX_PENDING
+        if dropped > 0:
+            del self.__pending[:dropped]
+            PUSH_SAMPLES.labels("dropped").inc(dropped)
+        PUSH_PENDING.set(len(self.__pending))
+
+    async def run(self):
+        """
+        sends the queued samples until cancelled
+        """
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=1),
+            timeout=aiohttp.ClientTimeout(total=PUSH_TIMEOUT),
+        ) as session:
+            while True:
+                try:
+                    await asyncio.wait_for(self.__flush.wait(), self.__interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.__flush.clear()
+                while self.__pending:
+                    if not await self.__send(session):
+                        # back off instead of retrying with every new batch
+                        await asyncio.sleep(self.__interval)
+                        break
+
+    async def __send(self, session):
+        """
+        sends the oldest batch of samples
+
+        :param session: the aiohttp.ClientSession to send with
+        :return: False if the batch was queued again to be retried
+        """
+        batch = self.__pending[: self.__batch_size]
+        del self.__pending[: len(batch)]
+        body = encode_write_request(batch)
+        try:
+            with PUSH_DURATION.time():
+                async with session.post(
+                    self.__url, data=body, headers=PUSH_HEADERS
+                ) as response:
+                    status = response.status
+                    await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return self.__retry(batch, repr(e))
+
+        if 400 <= status < 500 and status != 429:
+            logging.warning(
+                "Remote write to {} rejected {} samples with status {}".format(
+                    self.__url, len(batch), status
+                )
+            )
+            PUSH_FAILURES.labels("rejected").inc()
+            PUSH_SAMPLES.labels("rejected").inc(len(batch))
+        elif status >= 300:
+            return self.__retry(batch, "status {}".format(status))
+        else:
+            PUSH_SAMPLES.labels("sent").inc(len(batch))
+        PUSH_PENDING.set(len(self.__pending))
+        return True
+
+    def __retry(self, batch, reason):
+        logging.warning("Remote write to {} failed: {}".format(self.__url, reason))
+        PUSH_FAILURES.labels("error").inc()
+        self.__pending[:0] = batch
+        self.__trim()
+        return False
+
+
+def load_configs(config_file, auth_token, access_point, log_level):
+    """
+    loads the configuration of all homes
+
+    Homes are configured by --auth-token and --access-point or by the AUTH
+    section of the config file. Further homes are added to the config file
+    as sections named "AUTH <name>" with the same keys.
+
+    :return: a list of HmipConfig
+    """
+    if auth_token and access_point:
+        return [
+            homematicip.HmipConfig(
+                auth_token=auth_token,
+                access_point=access_point,
+                log_level=log_level,
+                log_file="hmip.log",
+                raw_config=None,
+            )
+        ]
+
+    config = configparser.ConfigParser()
+    with open(os.path.expanduser(config_file)) as f:
+        config.read_file(f)
+    log_file = config.get("LOGGING", "FileName", fallback="hmip.log")
+    configs = [
+        homematicip.HmipConfig(
+            section["AuthToken"],
+            section["AccessPoint"],
+            int(config.get("LOGGING", "Level", fallback=30)),
+            None if log_file == "None" else log_file,
+            config._sections,
         )
-        metric_dew_point_alarm_active = GaugeMetricFamily(
-            "hmip_dew_point_alarm_active",
-            "Dew Point Alarm Active",
-            labels=labelnames + ["channel", "channel_name"],
+        for name, section in config.items()
+        if name == "AUTH" or name.startswith("AUTH ")
+    ]
+    if not configs:
+        raise ValueError("no AUTH section in '{}'".format(config_file))
+    access_points = [c.access_point for c in configs]
+    if len(set(access_points)) != len(access_points):
+        raise ValueError("access points are configured more than once")
+    return configs
+
+
+async def run(collector, metric_port, writer=None):
+    """
+    serves the metrics and runs the collectors of all homes on the same
+    event loop
+
+    :param collector: the MultiHomeCollector to run
+    :param metric_port: the port to expose the metrics on
+    :param writer: the RemoteWriter the homes push to, if any
+    """
+    server = MetricsServer(prometheus_client.REGISTRY, metric_port)
+    start = time.perf_counter()
+    await server.start()
+    STARTUP_PHASE.labels("listen").set(time.perf_counter() - start)
+
+    async def connected():
+        start = time.perf_counter()
+        await asyncio.gather(*(home.wait_connected() for home in collector.homes))
+        STARTUP_PHASE.labels("connect").set(time.perf_counter() - start)
+        logging.info(
+            "All homes connected after {:.1f}s".format(time.perf_counter() - start)
         )
 
-        try:
-            # Weather Info
-            if self.__home_client.weather:
-                w = self.__home_client.weather
-                if w.temperature:
-                    metric_weather_temperature.add_metric(
-                        [self.__home_client.location.city], w.temperature
-                    )
-                if w.humidity:
-                    metric_weather_humidity.add_metric(
-                        [self.__home_client.location.city], w.humidity
-                    )
-                if w.vaporAmount:
-                    metric_weather_vapor_amount.add_metric(
-                        [self.__home_client.location.city], w.vaporAmount
-                    )
-                if w.windSpeed:
-                    metric_wind_speed.add_metric(
-                        [self.__home_client.location.city], w.windSpeed
-                    )
-                if w.minTemperature:
-                    metric_min_temperature.add_metric(
-                        [self.__home_client.location.city], w.minTemperature
-                    )
-                if w.maxTemperature:
-                    metric_max_temperature.add_metric(
-                        [self.__home_client.location.city], w.maxTemperature
-                    )
+    # every home and the writer are restarted on their own when they fail
+    tasks = [
+        connected(),
+        *(supervise(home.access_point, home.start) for home in collector.homes),
+    ]
+    if writer is not None:
+        tasks.append(supervise("push", writer.run))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await server.stop()
 
-            # Version Info
-            if self.__home_client.currentAPVersion:
-                version_info.add_metric([self.__home_client.currentAPVersion], 1)
-                yield version_info
-
-            # Duty Cycle Info
-            if self.__home_client.dutyCycle:
-                metric_duty_cycle_ratio.add_metric([], self.__home_client.dutyCycle)
-                yield metric_duty_cycle_ratio
-
-            for g in self.__home_client.groups:
-                if g.groupType == "META":
-                    for d in g.devices:
-                        # Device Info
-                        metric_device_info.add_metric(
-                            [
-                                g.label,
-                                d.label,
-                                d.deviceType.lower(),
-                                d.firmwareVersion,
-                                str(d.permanentlyReachable),
-                                d.id,
-                                d.modelType,
-                                str(d.connectionType),
-                            ],
-                            1,
-                        )
-                        if d.lastStatusUpdate:
-                            metric_last_status_update.add_metric(
-                                [g.label, d.label], d.lastStatusUpdate.timestamp()
-                            )
-
-                        # RSSI Metrics
-                        if getattr(d, "rssiDeviceValue", None):
-                            metric_rssi_device_value.add_metric(
-                                [g.label, d.label], d.rssiDeviceValue
-                            )
-                        if getattr(d, "rssiPeerValue", None):
-                            metric_rssi_peer_value.add_metric(
-                                [g.label, d.label], d.rssiPeerValue
-                            )
-
-                        # Status Metrics
-                        if getattr(d, "lowBat", None) is not None:
-                            metric_low_bat.add_metric([g.label, d.label], int(d.lowBat))
-                        if getattr(d, "unreach", None) is not None:
-                            metric_unreach.add_metric(
-                                [g.label, d.label], int(d.unreach)
-                            )
-                        if getattr(d, "configPending", None) is not None:
-                            metric_config_pending.add_metric(
-                                [g.label, d.label], int(d.configPending)
-                            )
-                        if getattr(d, "dutyCycle", None) is not None:
-                            metric_duty_cycle.add_metric(
-                                [g.label, d.label], int(d.dutyCycle)
-                            )
-
-                        # Specific Metrics
-                        if isinstance(d, WallMountedThermostatPro):
-                            if d.actualTemperature:
-                                metric_temperature_actual.add_metric(
-                                    [g.label, d.label], d.actualTemperature
-                                )
-                            if d.setPointTemperature:
-                                metric_temperature_setpoint.add_metric(
-                                    [g.label, d.label], d.setPointTemperature
-                                )
-                            if d.humidity:
-                                metric_humidity_actual.add_metric(
-                                    [g.label, d.label], d.humidity
-                                )
-                            if hasattr(d, "vaporAmount") and d.vaporAmount:
-                                metric_vapor_amount.add_metric(
-                                    [g.label, d.label], d.vaporAmount
-                                )
-                            if (
-                                hasattr(d, "temperatureOffset")
-                                and d.temperatureOffset is not None
-                            ):
-                                metric_temperature_offset.add_metric(
-                                    [g.label, d.label], d.temperatureOffset
-                                )
-                        elif isinstance(d, FloorTerminalBlock12):
-                            if (
-                                hasattr(d, "valveProtectionDuration")
-                                and d.valveProtectionDuration is not None
-                            ):
-                                metric_valve_protection_duration.add_metric(
-                                    [g.label, d.label], d.valveProtectionDuration
-                                )
-                            if (
-                                hasattr(d, "valveProtectionSwitchingInterval")
-                                and d.valveProtectionSwitchingInterval is not None
-                            ):
-                                metric_valve_protection_switching_interval.add_metric(
-                                    [g.label, d.label],
-                                    d.valveProtectionSwitchingInterval,
-                                )
-                            if (
-                                hasattr(d, "valveFlowError")
-                                and d.valveFlowError is not None
-                            ):
-                                metric_valve_flow_error.add_metric(
-                                    [g.label, d.label], int(d.valveFlowError)
-                                )
-                            if (
-                                hasattr(d, "valveWaterError")
-                                and d.valveWaterError is not None
-                            ):
-                                metric_valve_water_error.add_metric(
-                                    [g.label, d.label], int(d.valveWaterError)
-                                )
-                            if (
-                                hasattr(d, "minimumFloorHeatingValvePosition")
-                                and d.minimumFloorHeatingValvePosition is not None
-                            ):
-                                metric_minimum_floor_heating_valve_position.add_metric(
-                                    [g.label, d.label],
-                                    d.minimumFloorHeatingValvePosition,
-                                )
-
-                            for channel in d.functionalChannels:
-                                if isinstance(
-                                    channel, FloorTerminalBlockMechanicChannel
-                                ):
-                                    if channel.valvePosition is not None:
-                                        metric_heating_valve_position.add_metric(
-                                            [
-                                                g.label,
-                                                d.label,
-                                                str(channel.index),
-                                                channel.label,
-                                            ],
-                                            channel.valvePosition,
-                                        )
-                                    if (
-                                        hasattr(channel, "dewPointAlarmActive")
-                                        and channel.dewPointAlarmActive is not None
-                                    ):
-                                        metric_dew_point_alarm_active.add_metric(
-                                            [
-                                                g.label,
-                                                d.label,
-                                                str(channel.index),
-                                                channel.label,
-                                            ],
-                                            int(channel.dewPointAlarmActive),
-                                        )
-
-            yield metric_temperature_actual
-            yield metric_temperature_setpoint
-            yield metric_valve_adaption_needed
-            yield metric_temperature_offset
-            yield metric_heating_valve_position
-            yield metric_humidity_actual
-            yield metric_vapor_amount
-            yield metric_low_bat
-            yield metric_unreach
-            yield metric_config_pending
-            yield metric_duty_cycle
-            yield metric_valve_protection_duration
-            yield metric_valve_protection_switching_interval
-            yield metric_weather_temperature
-            yield metric_weather_humidity
-            yield metric_weather_vapor_amount
-            yield metric_wind_speed
-            yield metric_min_temperature
-            yield metric_max_temperature
-            yield metric_rssi_device_value
-            yield metric_rssi_peer_value
-            yield metric_last_status_update
-            yield metric_valve_flow_error
-            yield metric_valve_water_error
-            yield metric_minimum_floor_heating_valve_position
-            yield metric_dew_point_alarm_active
-            yield metric_device_info
 
+async def supervise(name, start):
+    """
+    runs a task of the exporter and restarts it with backoff when it fails
+
+    :param name: the name of the task, the access point of a home or "push"
+    :param start: a callable returning the coroutine of the task
+    """
+    failures = 0
+    while True:
+        started = time.monotonic()
+        try:
+            return await start()
         except Exception as e:
-            logging.warning(
-                "collecting status from device(s) failed with: {}".format(str(e))
+            if time.monotonic() - started > TASK_MAX_RESTART_DELAY:
+                # it ran fine for a while, this is a new failure
+                failures = 0
+            failures += 1
+            delay = min(
+                TASK_RESTART_DELAY * 2 ** (failures - 1), TASK_MAX_RESTART_DELAY
+            ) * random.uniform(0.5, 1.0)
+            logging.error(
+                "Task {} failed with: {!r}, restarting in {:.0f}s".format(
+                    name, e, delay
+                ),
+                exc_info=True,
             )
+            TASK_RESTARTS.labels(name).inc()
+            await asyncio.sleep(delay)
 
 
 if __name__ == "__main__":
-    import os
-
     parser = argparse.ArgumentParser(
         description="HomematicIP Prometheus Exporter",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -473,7 +2530,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--config-file",
         default=os.environ.get("CONFIG_FILE", "/etc/homematicip-rest-api/config.ini"),
-        help="path to the configuration file",
+        help="path to the configuration file, every AUTH section configures a home",
     )
     parser.add_argument(
         "--auth-token",
@@ -493,16 +2550,113 @@ if __name__ == "__main__":
         default=os.environ.get("REST_SYNC_INTERVAL", 600),
         help="interval in seconds to sync state via REST API",
     )
+    parser.add_argument(
+        "--rest-sync-max-interval",
+        default=os.environ.get("REST_SYNC_MAX_INTERVAL", 3600),
+        help="maximum interval in seconds between REST syncs while the WebSocket "
+        "delivers events",
+    )
+    parser.add_argument(
+        "--rest-budget",
+        default=os.environ.get("REST_BUDGET", 10),
+        help="number of REST syncs of the homes of an account allowed in a burst",
+    )
+    parser.add_argument(
+        "--rest-budget-interval",
+        default=os.environ.get("REST_BUDGET_INTERVAL", 60),
+        help="seconds after which a REST sync of --rest-budget is regained",
+    )
+    parser.add_argument(
+        "--event-gap-timeout",
+        default=os.environ.get("EVENT_GAP_TIMEOUT", 900),
+        help="seconds without WebSocket events after which the subscription is "
+        "restarted and the state is synced via REST API",
+    )
+    parser.add_argument(
+        "--event-series-limit",
+        default=os.environ.get("EVENT_SERIES_LIMIT", 1000),
+        help="maximum number of series of hmip_websocket_events_count_total",
+    )
+    parser.add_argument(
+        "--state-dir",
+        default=os.environ.get("STATE_DIR", None),
+        help="directory to save a snapshot of every home to, it is served on the "
+        "next start until the home is connected",
+    )
+    parser.add_argument(
+        "--state-save-interval",
+        default=os.environ.get("STATE_SAVE_INTERVAL", 300),
+        help="interval in seconds to save the snapshot to --state-dir",
+    )
+    parser.add_argument(
+        "--record-dir",
+        default=os.environ.get("RECORD_DIR", None),
+        help="directory to append the raw WebSocket messages of every home to, "
+        "with the time they were received, to be replayed by benchmark.py",
+    )
+    parser.add_argument(
+        "--stale-device-age",
+        default=os.environ.get("STALE_DEVICE_AGE", 3600),
+        help="seconds without a status update after which a device is re-applied "
+        "on the next REST sync",
+    )
+    parser.add_argument(
+        "--aggregate-window",
+        default=os.environ.get("AGGREGATE_WINDOW", 0),
+        help="seconds per window over which the minimum, maximum, mean and "
+        "number of temperatures, valve positions, humidity and power are "
+        "exported, set it to the scrape interval. 0 disables the aggregates",
+    )
+    parser.add_argument(
+        "--push-url",
+        default=os.environ.get("PUSH_URL", None),
+        help="Prometheus remote write endpoint to push changes from WebSocket "
+        "events to, with the time they were received",
+    )
+    parser.add_argument(
+        "--push-batch-size",
+        default=os.environ.get("PUSH_BATCH_SIZE", 500),
+        help="number of pending samples that triggers a remote write",
+    )
+    parser.add_argument(
+        "--push-interval",
+        default=os.environ.get("PUSH_INTERVAL", 5),
+        help="maximum seconds a sample is held back before a remote write",
+    )
 
     args = parser.parse_args()
 
     # Start up the server to expose the metrics.
     try:
-        collector = HomematicIPCollector(args)
+        start = time.perf_counter()
+        configs = load_configs(
+            args.config_file, args.auth_token, args.access_point, int(args.log_level)
+        )
+        logging.info(
+            "using config file '{}' for {} homes and exposing metrics on port "
+            "'{}'".format(args.config_file, len(configs), args.metric_port)
+        )
+        writer = None
+        if args.push_url:
+            writer = RemoteWriter(
+                args.push_url, int(args.push_batch_size), float(args.push_interval)
+            )
+        # budgets by auth token, the homes of an account share its limit
+        budgets = {}
+        for config in configs:
+            if config.auth_token not in budgets:
+                budgets[config.auth_token] = RestBudget(
+                    int(args.rest_budget), float(args.rest_budget_interval)
+                )
+        collector = MultiHomeCollector(
+            HomematicIPCollector(
+                args, config, writer=writer, budget=budgets[config.auth_token]
+            )
+            for config in configs
+        )
         prometheus_client.REGISTRY.register(collector)
-        prometheus_client.start_http_server(int(args.metric_port))
-        logging.info("Prometheus exporter started on port {}".format(args.metric_port))
-        asyncio.run(collector.start())
+        STARTUP_PHASE.labels("setup").set(time.perf_counter() - start)
+        asyncio.run(run(collector, int(args.metric_port), writer))
         # The start method will now run indefinitely
         # while True:
         #    time.sleep(1)
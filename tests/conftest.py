@@ -0,0 +1,46 @@
+"""
+fixtures shared by the tests
+"""
+
+import asyncio
+import contextlib
+
+import pytest
+
+import benchmark
+
+
+async def _stop(task):
+    """
+    cancels a task and waits until it is done
+    """
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+@pytest.fixture
+def started():
+    """
+    runs the collector of a home while in the block
+
+    Used as ``async with started(home, **args) as collector``, where the
+    collector is created by benchmark._collector with the given arguments.
+    The block is entered once the initial sync is done and the events of
+    the home are enabled, the collector is stopped when it is left.
+    """
+
+    @contextlib.asynccontextmanager
+    async def start(home, **args):
+        collector = benchmark._collector(home, **args)
+        task = asyncio.create_task(collector.start())
+        try:
+            async with asyncio.timeout(10):
+                await home.events_enabled.wait()
+            yield collector
+        finally:
+            await _stop(task)
+
+    return start
@@ -0,0 +1,141 @@
+"""
+REST budget of the homes of an account
+"""
+
+import asyncio
+
+from prometheus_client import CollectorRegistry
+from prometheus_client.parser import text_string_to_metric_families
+
+import benchmark
+import exporter
+
+
+async def _served(budget, *syncs):
+    """
+    queues the (priority, home) syncs and returns them in the order served
+    """
+    served = []
+
+    async def acquire(priority, home):
+        await budget.acquire(priority, home)
+        served.append((priority, home))
+
+    tasks = []
+    for priority, home in syncs:
+        tasks.append(asyncio.create_task(acquire(priority, home)))
+        await asyncio.sleep(0)
+    await asyncio.wait_for(asyncio.gather(*tasks), 5)
+    return served
+
+
+def test_catch_up_sync_goes_ahead_of_routine_syncs_of_other_homes():
+    async def check():
+        budget = exporter.RestBudget(1, 0.02)
+        budget.drain()
+        return await _served(
+            budget, ("routine", "AP1"), ("routine", "AP2"), ("catch_up", "AP3")
+        )
+
+    assert asyncio.run(check()) == [
+        ("catch_up", "AP3"),
+        ("routine", "AP1"),
+        ("routine", "AP2"),
+    ]
+
+
+def test_home_served_least_recently_goes_first():
+    async def check():
+        budget = exporter.RestBudget(1, 0.02)
+        await budget.acquire("routine", "AP1")
+        return await _served(
+            budget, ("routine", "AP1"), ("routine", "AP1"), ("routine", "AP2")
+        )
+
+    assert asyncio.run(check()) == [
+        ("routine", "AP2"),
+        ("routine", "AP1"),
+        ("routine", "AP1"),
+    ]
+
+
+def test_initial_syncs_do_not_wait_but_are_owed():
+    async def check():
+        budget = exporter.RestBudget(2, 3600)
+        for home in ("AP1", "AP2", "AP3"):
+            await asyncio.wait_for(budget.acquire("initial", home), 1)
+        remaining = budget.remaining()
+        try:
+            await asyncio.wait_for(budget.acquire("catch_up", "AP1"), 0.05)
+        except asyncio.TimeoutError:
+            return remaining, False
+        return remaining, True
+
+    remaining, served = asyncio.run(check())
+    assert -1.01 < remaining < -0.99
+    assert not served
+
+
+def test_throttling_empties_the_budget():
+    budget = exporter.RestBudget(10, 3600)
+    budget.drain()
+    assert budget.remaining() < 0.01
+
+
+def test_remaining_budget_is_fresh_in_the_exposition():
+    registry = CollectorRegistry()
+    registry.register(exporter.REST_BUDGET)
+    server = exporter.MetricsServer(registry, 0)
+    budget = exporter.RestBudget(10, 3600)
+    benchmark._collector(benchmark.FakeHome({}), budget=budget)
+
+    def remaining():
+        body = server.exposition("", "")[0].decode()
+        for family in text_string_to_metric_families(body):
+            for sample in family.samples:
+                if sample.labels.get("access_point") == benchmark.HOME_ID:
+                    return sample.value
+
+    before = remaining()
+    asyncio.run(budget.acquire("routine", benchmark.HOME_ID))
+    assert before - remaining() > 0.99
+
+
+def test_failed_full_sync_is_retried_as_catch_up(started, monkeypatch):
+    monkeypatch.setattr(exporter, "SYNC_RETRY_DELAY", 0)
+
+    class Home(benchmark.FakeHome):
+        downloads = 0
+
+        async def download_configuration_async(self):
+            self.downloads += 1
+            if self.downloads == 2:
+                raise RuntimeError("unavailable")
+            return await super().download_configuration_async()
+
+    class Budget(exporter.RestBudget):
+        def __init__(self):
+            super().__init__(100, 60)
+            self.priorities = []
+            self.enough = asyncio.Event()
+
+        async def acquire(self, priority, home):
+            self.priorities.append(priority)
+            if len(self.priorities) == 4:
+                self.enough.set()
+            await super().acquire(priority, home)
+
+    async def check():
+        budget = Budget()
+        # every periodic sync is a full one and due right away
+        async with started(
+            Home(benchmark.synthetic_state(16)),
+            budget=budget,
+            rest_sync_interval=0,
+            rest_sync_max_interval=0,
+        ):
+            await asyncio.wait_for(budget.enough.wait(), 5)
+        return budget.priorities
+
+    # the start, the failed full sync, its retry and the next full sync
+    assert asyncio.run(check())[:4] == ["initial", "routine", "catch_up", "routine"]
@@ -0,0 +1,159 @@
+"""
+HomeClient against a local stand-in of the lookup, REST and WebSocket endpoints
+"""
+
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from homematicip.connection.connection_context import ConnectionContextBuilder
+from homematicip.exceptions.connection_exceptions import (
+    HmipAuthenticationError,
+    HmipConnectionError,
+)
+
+import benchmark
+import exporter
+
+AUTH_TOKEN = "0123456789ABCDEF"
+
+
+class Cloud(object):
+    """
+    the HomematicIP cloud answering REST calls with the given statuses, then
+    200, and sending the given messages to every WebSocket client
+    """
+
+    def __init__(self, json_state, *statuses, messages=()):
+        self.json_state = json_state
+        self.statuses = list(statuses)
+        self.messages = list(messages)
+        self.requests = []
+        self.websockets = []
+
+    async def get_host(self, request):
+        return web.json_response(
+            {"urlREST": self.url, "urlWebSocket": self.url.replace("http", "ws", 1)}
+        )
+
+    async def get_current_state(self, request):
+        self.requests.append((request.headers, await request.json()))
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status != 200:
+            return web.Response(status=status)
+        return web.json_response(self.json_state)
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.websockets.append(request.headers)
+        for message in self.messages:
+            await ws.send_str(message)
+        async for _ in ws:
+            pass
+        return ws
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post("/getHost", self.get_host)
+        app.router.add_post("/hmip/home/getCurrentState", self.get_current_state)
+        app.router.add_get("/", self.websocket)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = "http://127.0.0.1:{}".format(port)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.runner.cleanup()
+
+
+@pytest.fixture
+def cloud(monkeypatch):
+    """
+    :return: a function returning a Cloud the HomeClient looks up
+    """
+
+    def cloud(*args, **kwargs):
+        cloud = Cloud(*args, **kwargs)
+        build_context_async = ConnectionContextBuilder.build_context_async
+
+        async def build_context(**kwargs):
+            kwargs.update(lookup_url=cloud.url + "/getHost", enforce_ssl=False)
+            return await build_context_async(**kwargs)
+
+        monkeypatch.setattr(
+            ConnectionContextBuilder, "build_context_async", build_context
+        )
+        return cloud
+
+    return cloud
+
+
+async def _client():
+    client = exporter.HomeClient()
+    await client.init_async(benchmark.HOME_ID, AUTH_TOKEN)
+    return client
+
+
+def test_current_state_is_downloaded(cloud):
+    json_state = benchmark.synthetic_state(16)
+
+    async def check():
+        async with cloud(json_state) as stand_in:
+            client = await _client()
+            return await client.download_configuration_async(), stand_in.requests
+
+    state, ((headers, body),) = asyncio.run(check())
+    assert state == json_state
+    assert headers["AUTHTOKEN"] == AUTH_TOKEN
+    assert body["id"] == benchmark.HOME_ID
+
+
+@pytest.mark.parametrize(
+    "status, error", [(403, HmipAuthenticationError), (500, HmipConnectionError)]
+)
+def test_failed_download_raises(cloud, status, error):
+    async def check():
+        async with cloud({}, status) as stand_in:
+            client = await _client()
+            with pytest.raises(error, match=str(status)):
+                await client.download_configuration_async()
+            # the next call succeeds again
+            return await client.download_configuration_async(), stand_in.requests
+
+    state, requests = asyncio.run(check())
+    assert state == {}
+    assert len(requests) == 2
+
+
+def test_events_are_passed_to_the_handlers(cloud):
+    messages = [json.dumps({"events": {}}), json.dumps({"events": {"0": {}}})]
+
+    async def check():
+        async with cloud({}, messages=messages) as stand_in:
+            client = await _client()
+            received = []
+            connected = asyncio.Event()
+            before = client.websocket_is_connected()
+            await client.enable_events(received.append)
+            client.set_on_connected_handler(connected.set)
+            async with asyncio.timeout(5):
+                await connected.wait()
+                while len(received) < len(messages):
+                    await asyncio.sleep(0.01)
+            during = client.websocket_is_connected()
+            # subscribing again keeps the connected socket
+            await client.enable_events(received.append)
+            await client.disable_events_async()
+            after = client.websocket_is_connected()
+            return received, (before, during, after), stand_in.websockets
+
+    received, states, (headers,) = asyncio.run(check())
+    assert received == messages
+    assert states == (False, True, False)
+    assert headers["AUTHTOKEN"] == AUTH_TOKEN
+    assert headers["ACCESSPOINT-ID"] == benchmark.HOME_ID
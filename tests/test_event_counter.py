@@ -0,0 +1,62 @@
+"""
+bounded series of the WebSocket event counter
+"""
+
+import exporter
+
+
+def _series(counter):
+    events, series, evicted = counter.collect()
+    counts = {
+        tuple(sample.labels[label] for label in ("event_type", "id")): sample.value
+        for sample in events.samples
+        if sample.name.endswith("_total")
+    }
+    return counts, series.samples[0].value, evicted.samples[0].value
+
+
+def test_overflow_series_count_towards_the_limit():
+    counter = exporter.EventCounter(3, "AP")
+    for i in range(10):
+        counter.inc("DEVICE_CHANGED", "device {}".format(i), "", "")
+    counter.inc("GROUP_CHANGED", "group", "", "")
+
+    counts, live, evicted = _series(counter)
+    assert live == len(counts) == 3
+    # the two least recently used devices made room for the overflow series
+    assert counts == {
+        ("DEVICE_CHANGED", "device 2"): 1,
+        ("DEVICE_CHANGED", exporter.EVENT_OVERFLOW_ID): 7,
+        ("GROUP_CHANGED", exporter.EVENT_OVERFLOW_ID): 1,
+    }
+    assert evicted == 2
+
+
+def test_least_recently_used_series_is_evicted():
+    counter = exporter.EventCounter(3, "AP")
+    counter.inc("DEVICE_CHANGED", "a", "", "")
+    counter.inc("DEVICE_CHANGED", "b", "", "")
+    counter.inc("DEVICE_CHANGED", "c", "", "")
+    counter.inc("DEVICE_CHANGED", "a", "", "")
+    # b is the least recently used when the overflow series needs room
+    counter.inc("DEVICE_CHANGED", "d", "", "")
+
+    counts, live, evicted = _series(counter)
+    assert counts == {
+        ("DEVICE_CHANGED", "a"): 2,
+        ("DEVICE_CHANGED", "c"): 1,
+        ("DEVICE_CHANGED", exporter.EVENT_OVERFLOW_ID): 1,
+    }
+    assert evicted == 1
+
+
+def test_prune_drops_removed_and_renamed_objects():
+    counter = exporter.EventCounter(10, "AP")
+    counter.inc("DEVICE_CHANGED", "a", "kitchen", "")
+    counter.inc("DEVICE_CHANGED", "b", "hall", "")
+    counter.inc("DEVICE_CHANGED", "c", "bath", "")
+    counter.prune({"a": "kitchen", "b": "corridor"})
+
+    counts, live, evicted = _series(counter)
+    assert counts == {("DEVICE_CHANGED", "a"): 1}
+    assert evicted == 2
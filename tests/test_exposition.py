@@ -0,0 +1,231 @@
+"""
+encoding and caching of the exposition by the MetricsServer
+"""
+
+import asyncio
+import gzip
+import json
+import time
+
+import prometheus_client
+from prometheus_client import CollectorRegistry
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.openmetrics.parser import (
+    text_string_to_metric_families as openmetrics_families,
+)
+from prometheus_client.parser import text_string_to_metric_families
+
+import benchmark
+import exporter
+
+
+class Families(object):
+    def __init__(self, *families):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+
+def _gauge(name, value):
+    family = GaugeMetricFamily(name, name)
+    family.add_metric([], value)
+    return family
+
+
+def _values(body):
+    return {
+        sample.name: sample.value
+        for family in text_string_to_metric_families(body.decode())
+        for sample in family.samples
+    }
+
+
+def test_unchanged_families_are_not_encoded_again(monkeypatch):
+    encoded = []
+
+    def choose_encoder(accept):
+        encoder, content_type = prometheus_client.exposition.choose_encoder(accept)
+
+        def counting(registry):
+            encoded.extend(family.name for family in registry.collect())
+            return encoder(registry)
+
+        return counting, content_type
+
+    monkeypatch.setattr(exporter, "choose_encoder", choose_encoder)
+    static = _gauge("static", 1)
+    collector = Families(static, _gauge("volatile", 1))
+    registry = CollectorRegistry()
+    registry.register(collector)
+    server = exporter.MetricsServer(registry, 0)
+
+    assert _values(server.exposition("", "")[0]) == {"static": 1, "volatile": 1}
+    assert encoded == ["static", "volatile"]
+
+    del encoded[:]
+    collector.families = (static, _gauge("volatile", 2))
+    assert _values(server.exposition("", "")[0]) == {"static": 1, "volatile": 2}
+    assert encoded == ["volatile"]
+
+
+def test_selections_share_the_encoded_families(monkeypatch):
+    encoded = []
+
+    def choose_encoder(accept):
+        encoder, content_type = prometheus_client.exposition.choose_encoder(accept)
+
+        def counting(registry):
+            encoded.extend(family.name for family in registry.collect())
+            return encoder(registry)
+
+        return counting, content_type
+
+    monkeypatch.setattr(exporter, "choose_encoder", choose_encoder)
+    registry = CollectorRegistry()
+    registry.register(Families(_gauge("static", 1), _gauge("other", 2)))
+    server = exporter.MetricsServer(registry, 0)
+
+    server.exposition("", "")
+    del encoded[:]
+    for names in ({"static"}, {"other"}, {"static", "other"}):
+        selection = exporter.Selection(
+            frozenset(names), frozenset(), frozenset(), frozenset()
+        )
+        body = server.exposition("", "", selection)[0]
+        assert set(_values(body)) == names
+    assert encoded == []
+
+
+def test_encoded_families_are_dropped_with_the_family():
+    collector = Families(_gauge("volatile", 1))
+    registry = CollectorRegistry()
+    registry.register(collector)
+    server = exporter.MetricsServer(registry, 0)
+    for i in range(10):
+        collector.families = (_gauge("volatile", i),)
+        server.exposition("", "")
+    content_type = prometheus_client.exposition.choose_encoder("")[1]
+    assert len(server._MetricsServer__encoded[content_type]) == 1
+    del collector.families
+    assert server._MetricsServer__encoded[content_type] == {}
+
+
+def test_unchanged_families_are_compressed_only_once(monkeypatch):
+    compressed = []
+    compress = gzip.compress
+
+    def counting(data, *args, **kwargs):
+        compressed.append(data)
+        return compress(data, *args, **kwargs)
+
+    monkeypatch.setattr(exporter.gzip, "compress", counting)
+    static = [_gauge("static_{}".format(i), i) for i in range(100)]
+    collector = Families(*static, _gauge("volatile", 1))
+    registry = CollectorRegistry()
+    registry.register(collector)
+    server = exporter.MetricsServer(registry, 0)
+
+    bodies = []
+    for i in range(3):
+        del compressed[:]
+        # like the event counters, the volatile family is new on every scrape
+        collector.families = (*static, _gauge("volatile", i))
+        bodies.append(server.exposition("", "gzip")[0])
+    # encoded by the first scrape, compressed as a run by the second and
+    # reused by the third
+    assert [b"static" in data for data in compressed] == [False]
+    assert _values(gzip.decompress(bodies[-1]))["volatile"] == 2
+    assert gzip.decompress(bodies[0]).replace(b"volatile 0.0", b"volatile 2.0") == (
+        gzip.decompress(bodies[-1])
+    )
+
+
+def test_gzip_and_openmetrics_match_the_text_exposition():
+    big = GaugeMetricFamily("big", "big", labels=["i"])
+    for i in range(10000):
+        big.add_metric([str(i)], i)
+    registry = CollectorRegistry()
+    registry.register(Families(_gauge("small", 1), big, _gauge("last", 2)))
+    server = exporter.MetricsServer(registry, 0)
+
+    plain, content_type, compressed = server.exposition("", "")
+    assert not compressed
+    assert len(plain) > exporter.GZIP_MEMBER_SIZE
+    for _ in range(2):
+        body, _, compressed = server.exposition("", "gzip")
+        assert compressed
+        assert gzip.decompress(body) == plain
+
+    body, content_type, _ = server.exposition("application/openmetrics-text", "")
+    assert content_type.startswith("application/openmetrics-text")
+    assert body.count(b"# EOF\n") == 1 and body.endswith(b"# EOF\n")
+    assert [f.name for f in openmetrics_families(body.decode())] == [
+        "small",
+        "big",
+        "last",
+    ]
+
+
+def test_counters_are_fresh_after_messages_without_changes(started):
+    async def check():
+        json_state = benchmark.synthetic_state(16)
+        home = benchmark.FakeHome(json_state)
+        device = next(iter(json_state["devices"].values()))
+        message = json.dumps(
+            {"events": {"0": {"pushEventType": "DEVICE_CHANGED", "device": device}}}
+        )
+        bodies = []
+        async with started(home) as collector:
+            registry = CollectorRegistry()
+            registry.register(exporter.MultiHomeCollector([collector]))
+            registry.register(exporter.EVENT_BYTES)
+            server = exporter.MetricsServer(registry, 0)
+            for _ in range(3):
+                # the device is unchanged, only the counters move
+                await home.deliver(message)
+                bodies.append(server.exposition("", "")[0])
+        return bodies, device
+
+    bodies, device = asyncio.run(check())
+    counts = []
+    received = []
+    for body in bodies:
+        for family in text_string_to_metric_families(body.decode()):
+            for sample in family.samples:
+                if (
+                    sample.name == "hmip_websocket_events_count_total"
+                    and sample.labels["id"] == device["id"]
+                ):
+                    counts.append(sample.value)
+                elif sample.name == "hmip_websocket_events_bytes_total":
+                    received.append(sample.value)
+    assert counts == [1, 2, 3]
+    assert received[0] < received[1] < received[2]
+
+
+def test_scrape_duration_includes_encoding(monkeypatch):
+    def choose_encoder(accept):
+        encoder, content_type = prometheus_client.exposition.choose_encoder(accept)
+
+        def slow(registry):
+            time.sleep(0.05)
+            return encoder(registry)
+
+        return slow, content_type
+
+    def observed(name):
+        return (
+            prometheus_client.REGISTRY.get_sample_value(name, {"encoding": "gzip"}) or 0
+        )
+
+    monkeypatch.setattr(exporter, "choose_encoder", choose_encoder)
+    registry = CollectorRegistry()
+    registry.register(Families(_gauge("slow", 1)))
+    server = exporter.MetricsServer(registry, 0)
+    count = observed("hmip_exporter_scrape_duration_seconds_count")
+    total = observed("hmip_exporter_scrape_duration_seconds_sum")
+    server.exposition("", "gzip")
+    assert observed("hmip_exporter_scrape_duration_seconds_count") == count + 1
+    # the trailer and the family were encoded
+    assert observed("hmip_exporter_scrape_duration_seconds_sum") - total >= 0.1
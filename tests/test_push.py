@@ -0,0 +1,313 @@
+"""
+remote write of the RemoteWriter against a local receiver
+"""
+
+import asyncio
+import struct
+
+import prometheus_client
+from aiohttp import web
+from prometheus_client import CollectorRegistry
+from prometheus_client.parser import text_string_to_metric_families
+
+import benchmark
+import exporter
+
+KEY = ("hmip_current_temperature_celsius", ("AP", "kitchen", "thermostat"))
+CHANNEL_KEY = ("hmip_heating_valve_position", ("AP", "kitchen", "valve", "1", ""))
+
+
+def _varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, offset
+
+
+def _snappy_literals(data):
+    """
+    decompresses a snappy block made of literals only
+    """
+    length, offset = _varint(data, 0)
+    out = bytearray()
+    while offset < len(data):
+        tag = data[offset]
+        assert tag & 3 == 0, "copies are not expected"
+        size = tag >> 2
+        offset += 1
+        if size >= 60:
+            extra = size - 59
+            size = int.from_bytes(data[offset : offset + extra], "little")
+            offset += extra
+        out += data[offset : offset + size + 1]
+        offset += size + 1
+    assert len(out) == length
+    return bytes(out)
+
+
+def _fields(data):
+    """
+    parses a protobuf message into (field number, value) pairs
+    """
+    offset = 0
+    while offset < len(data):
+        key, offset = _varint(data, offset)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, offset = _varint(data, offset)
+        elif wire_type == 1:
+            value = data[offset : offset + 8]
+            offset += 8
+        else:
+            assert wire_type == 2
+            size, offset = _varint(data, offset)
+            value = data[offset : offset + size]
+            offset += size
+        yield number, value
+
+
+def decode_write_request(body):
+    """
+    :return: a list of (labels, [(value bytes, timestamp)]) per time series
+    """
+    series = []
+    for number, timeseries in _fields(_snappy_literals(body)):
+        assert number == 1
+        labels = []
+        samples = []
+        for field, value in _fields(timeseries):
+            if field == 1:
+                pair = dict(_fields(value))
+                labels.append((pair[1].decode(), pair[2].decode()))
+            elif field == 2:
+                sample = dict(_fields(value))
+                samples.append((sample[1], sample[2]))
+        series.append((labels, samples))
+    return series
+
+
+class Receiver(object):
+    """
+    a remote write endpoint answering with the given statuses, then 204
+    """
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.requests = []
+
+    async def handle(self, request):
+        assert request.headers["Content-Encoding"] == "snappy"
+        assert request.headers["Content-Type"] == "application/x-protobuf"
+        self.requests.append(decode_write_request(await request.read()))
+        status = self.statuses.pop(0) if self.statuses else 204
+        return web.Response(status=status)
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post("/api/v1/write", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = "http://127.0.0.1:{}/api/v1/write".format(port)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.runner.cleanup()
+
+
+def _samples(outcome):
+    return (
+        prometheus_client.REGISTRY.get_sample_value(
+            "hmip_push_samples_total", {"outcome": outcome}
+        )
+        or 0
+    )
+
+
+async def _push(receiver, samples, batch_size=2):
+    """
+    pushes the samples and waits until all of them were sent or rejected
+    """
+    done = _samples("sent") + _samples("rejected") + len(samples)
+    writer = exporter.RemoteWriter(receiver.url, batch_size, 0.01)
+    task = asyncio.create_task(writer.run())
+    for key, value, timestamp in samples:
+        writer.add(key, value, timestamp)
+    try:
+        async with asyncio.timeout(5):
+            while _samples("sent") + _samples("rejected") < done:
+                await asyncio.sleep(0.01)
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+def test_labels_values_and_stale_markers():
+    async def check():
+        async with Receiver() as receiver:
+            await _push(receiver, [(KEY, 21.5, 1000), (CHANNEL_KEY, None, 2000)])
+            return receiver.requests
+
+    requests = asyncio.run(check())
+    assert requests == [
+        [
+            (
+                [
+                    ("__name__", "hmip_current_temperature_celsius"),
+                    ("access_point", "AP"),
+                    ("device_label", "thermostat"),
+                    ("room", "kitchen"),
+                ],
+                [(struct.pack("<d", 21.5), 1000)],
+            ),
+            (
+                # the empty channel_name is left out
+                [
+                    ("__name__", "hmip_heating_valve_position"),
+                    ("access_point", "AP"),
+                    ("channel", "1"),
+                    ("device_label", "valve"),
+                    ("room", "kitchen"),
+                ],
+                [(exporter.PUSH_STALE_MARKER, 2000)],
+            ),
+        ]
+    ]
+
+
+def test_samples_of_a_series_sharing_a_timestamp_are_reduced():
+    async def check():
+        async with Receiver() as receiver:
+            await _push(
+                receiver, [(KEY, 20.0, 1000), (KEY, 21.0, 1000), (KEY, 22.0, 2000)], 3
+            )
+            return receiver.requests
+
+    (request,) = asyncio.run(check())
+    assert request[0][1] == [
+        (struct.pack("<d", 21.0), 1000),
+        (struct.pack("<d", 22.0), 2000),
+    ]
+
+
+def test_rejected_batches_are_dropped():
+    async def check():
+        async with Receiver(400) as receiver:
+            await _push(receiver, [(KEY, 21.5, 1000), (KEY, 22.5, 2000)])
+            return receiver.requests
+
+    rejected = _samples("rejected")
+    requests = asyncio.run(check())
+    assert len(requests) == 1
+    assert _samples("rejected") - rejected == 2
+
+
+def test_failed_batches_are_sent_again():
+    async def check():
+        async with Receiver(503, 429) as receiver:
+            await _push(receiver, [(KEY, 21.5, 1000), (KEY, 22.5, 2000)])
+            return receiver.requests
+
+    sent = _samples("sent")
+    requests = asyncio.run(check())
+    assert len(requests) == 3
+    assert requests[0] == requests[1] == requests[2]
+    assert _samples("sent") - sent == 2
+
+
+def test_push_metrics_are_fresh_in_the_exposition():
+    registry = CollectorRegistry()
+    registry.register(exporter.PUSH_SAMPLES)
+    server = exporter.MetricsServer(registry, 0)
+
+    def sent():
+        body = server.exposition("", "")[0].decode()
+        for family in text_string_to_metric_families(body):
+            for sample in family.samples:
+                if sample.name == "hmip_push_samples_total":
+                    if sample.labels["outcome"] == "sent":
+                        return sample.value
+        return 0
+
+    async def check():
+        async with Receiver() as receiver:
+            await _push(receiver, [(KEY, 21.5, 1000), (KEY, 22.5, 2000)])
+
+    before = sent()
+    asyncio.run(check())
+    assert sent() - before == 2
+
+
+class Writer(object):
+    """
+    records the samples handed to a RemoteWriter
+    """
+
+    def __init__(self):
+        self.samples = []
+
+    def add(self, key, value, timestamp):
+        self.samples.append((key, value))
+
+
+def _temperatures(writer):
+    return [
+        (key[1][2], value)
+        for key, value in writer.samples
+        if key[0] == "hmip_current_temperature_celsius"
+    ]
+
+
+def test_corrections_of_rest_syncs_are_pushed(started):
+    async def check():
+        json_state = benchmark.synthetic_state(64)
+        devices = [
+            js
+            for js in json_state["devices"].values()
+            if js["type"] == "WALL_MOUNTED_THERMOSTAT_PRO"
+        ]
+        corrected, removed = devices[0], devices[1]
+        writer = Writer()
+        async with started(benchmark.FakeHome(json_state), writer=writer) as collector:
+            # the initial sync pushes every series
+            initial = _temperatures(writer)
+            del writer.samples[:]
+            # changes missed by the WebSocket
+            corrected["functionalChannels"]["1"]["actualTemperature"] = 30.5
+            del json_state["devices"][removed["id"]]
+            await collector._HomematicIPCollector__sync()
+        return initial, writer, corrected, removed
+
+    initial, writer, corrected, removed = asyncio.run(check())
+    assert {label for label, _ in initial} >= {corrected["label"], removed["label"]}
+    assert (corrected["label"], 30.5) not in initial
+    assert set(_temperatures(writer)) == {
+        (corrected["label"], 30.5),
+        (removed["label"], None),
+    }
+
+
+def test_unchanged_series_are_pushed_again(started, monkeypatch):
+    monkeypatch.setattr(exporter, "PUSH_REFRESH_INTERVAL", 0.02)
+
+    async def check():
+        json_state = benchmark.synthetic_state(16)
+        writer = Writer()
+        async with started(benchmark.FakeHome(json_state), writer=writer):
+            initial = list(writer.samples)
+            del writer.samples[:]
+            # one pass over all devices
+            await asyncio.sleep(0.1)
+        return initial, writer.samples
+
+    initial, refreshed = asyncio.run(check())
+    assert set(initial) <= set(refreshed)
@@ -0,0 +1,24 @@
+"""
+recording of the WebSocket messages with --record-dir
+"""
+
+import asyncio
+
+import benchmark
+
+
+def test_messages_are_written_and_closed_on_cancellation(started, tmp_path):
+    async def check():
+        json_state = benchmark.synthetic_state(16)
+        messages = benchmark.synthetic_events(json_state, 50)
+        home = benchmark.FakeHome(json_state)
+        async with started(home, record_dir=str(tmp_path)):
+            for message in messages:
+                await home.deliver(message)
+        # stopped with messages still queued, they are written on closing
+        return messages
+
+    messages = asyncio.run(check())
+    (path,) = tmp_path.iterdir()
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert [line.split(" ", 1)[1] for line in lines] == messages
@@ -0,0 +1,99 @@
+"""
+isolation and restart of the tasks of the exporter
+"""
+
+import asyncio
+
+import prometheus_client
+import pytest
+
+import benchmark
+import exporter
+
+
+def _restarts(name):
+    return (
+        prometheus_client.REGISTRY.get_sample_value(
+            "hmip_exporter_task_restarts_total", {"task": name}
+        )
+        or 0
+    )
+
+
+def test_supervise_restarts_a_failed_task(monkeypatch):
+    monkeypatch.setattr(exporter, "TASK_RESTART_DELAY", 0)
+    attempts = []
+
+    async def start():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RuntimeError("attempt {}".format(len(attempts)))
+        return "done"
+
+    before = _restarts("flaky")
+    assert asyncio.run(exporter.supervise("flaky", start)) == "done"
+    assert len(attempts) == 3
+    assert _restarts("flaky") - before == 2
+
+
+def test_supervise_does_not_swallow_cancellation():
+    async def check():
+        task = asyncio.create_task(exporter.supervise("idle", asyncio.Event().wait))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(check())
+
+
+def test_failed_home_is_cleaned_up_and_restarted(monkeypatch):
+    monkeypatch.setattr(exporter, "TASK_RESTART_DELAY", 0)
+
+    class Home(benchmark.FakeHome):
+        disabled = 0
+
+        async def disable_events_async(self):
+            self.disabled += 1
+
+    async def check():
+        home = Home(benchmark.synthetic_state(16))
+        collector = benchmark._collector(home)
+        runs = []
+        running = asyncio.Event()
+
+        async def periodic_collection():
+            runs.append(1)
+            if len(runs) == 1:
+                raise RuntimeError("bug")
+            running.set()
+            await asyncio.Event().wait()
+
+        collector._HomematicIPCollector__periodic_collection = periodic_collection
+        up = []
+        task = asyncio.create_task(
+            exporter.supervise(collector.access_point, collector.start)
+        )
+        await running.wait()
+        up.append(
+            prometheus_client.REGISTRY.get_sample_value(
+                "hmip_home_up", {"access_point": collector.access_point}
+            )
+        )
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        up.append(
+            prometheus_client.REGISTRY.get_sample_value(
+                "hmip_home_up", {"access_point": collector.access_point}
+            )
+        )
+        return runs, home.disabled, up
+
+    runs, disabled, up = asyncio.run(check())
+    assert len(runs) == 2
+    # closed after the failure and after the cancellation
+    assert disabled == 2
+    assert up == [1, 0]
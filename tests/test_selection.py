@@ -0,0 +1,173 @@
+"""
+selection of families and devices by /metrics query parameters
+"""
+
+from multidict import MultiDict
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+import exporter
+
+INFO_LABELS = ["access_point", "room", "device_label", "device_type", "device_id"]
+DEVICE_LABELS = ["access_point", "room", "device_label"]
+
+
+class Families(object):
+    def __init__(self, *families):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+
+def _home():
+    """
+    two homes with a thermostat labelled alike in a room of the same name
+    """
+    info = GaugeMetricFamily("hmip_device_info", "", labels=INFO_LABELS)
+    low_bat = GaugeMetricFamily("hmip_low_bat", "", labels=DEVICE_LABELS)
+    temperature = GaugeMetricFamily(
+        "hmip_current_temperature_celsius", "", labels=DEVICE_LABELS
+    )
+    for access_point, room, label, device_type, device_id in (
+        ("AP1", "kitchen", "thermostat", "heating_thermostat", "1"),
+        ("AP1", "kitchen", "window", "shutter_contact", "2"),
+        ("AP1", "hall", "hall thermostat", "heating_thermostat", "3"),
+        ("AP2", "kitchen", "thermostat", "wall_mounted_thermostat_pro", "4"),
+    ):
+        info.add_metric([access_point, room, label, device_type, device_id], 1)
+        low_bat.add_metric([access_point, room, label], 0)
+        if "thermostat" in device_type:
+            temperature.add_metric([access_point, room, label], 21)
+    duty_cycle = GaugeMetricFamily("hmip_duty_cycle", "", labels=["access_point"])
+    duty_cycle.add_metric(["AP1"], 8)
+    events = CounterMetricFamily(
+        "hmip_websocket_events_bytes", "", labels=["access_point"]
+    )
+    events.add_metric(["AP1"], 100, created=1.0)
+    return Families(info, low_bat, temperature, duty_cycle, events)
+
+
+def _select(registry, **query):
+    query = MultiDict(
+        (key, value)
+        for key, values in query.items()
+        for value in (values if isinstance(values, list) else [values])
+    )
+    selected = exporter.SelectedRegistry(registry, exporter.parse_selection(query))
+    return {
+        family.name: sorted(
+            (
+                sample.name,
+                sample.labels.get("access_point"),
+                sample.labels.get("device_label"),
+            )
+            for sample in family.samples
+        )
+        for family in selected.collect()
+    }
+
+
+def _names(registry, **query):
+    return sorted(_select(registry, **query))
+
+
+def test_parse_selection():
+    assert exporter.parse_selection(MultiDict()) is None
+    assert exporter.parse_selection(MultiDict(debug="1")) is None
+    selection = exporter.parse_selection(
+        MultiDict(
+            [
+                ("name[]", "hmip_low_bat"),
+                ("name[]", "hmip_unreachable"),
+                ("room", "kitchen"),
+                ("type", "HEATING_THERMOSTAT"),
+            ]
+        )
+    )
+    assert selection == exporter.Selection(
+        frozenset({"hmip_low_bat", "hmip_unreachable"}),
+        frozenset({"kitchen"}),
+        frozenset(),
+        frozenset({"heating_thermostat"}),
+    )
+    # hashable, the server caches expositions by selection
+    assert hash(selection) is not None
+
+
+def test_names_select_families_or_samples():
+    registry = _home()
+    assert _names(registry, **{"name[]": "hmip_low_bat"}) == ["hmip_low_bat"]
+    # a family name selects all of its samples, a sample name only those
+    assert _select(registry, **{"name[]": "hmip_websocket_events_bytes"}) == {
+        "hmip_websocket_events_bytes": [
+            ("hmip_websocket_events_bytes_created", "AP1", None),
+            ("hmip_websocket_events_bytes_total", "AP1", None),
+        ]
+    }
+    assert _select(registry, **{"name[]": "hmip_websocket_events_bytes_total"}) == {
+        "hmip_websocket_events_bytes": [
+            ("hmip_websocket_events_bytes_total", "AP1", None),
+        ]
+    }
+    assert _names(registry, **{"name[]": "unknown"}) == []
+
+
+def test_device_filters_are_combined():
+    registry = _home()
+    low_bat = {"name[]": "hmip_low_bat"}
+    assert _select(registry, room="kitchen", type="HEATING_THERMOSTAT", **low_bat) == {
+        "hmip_low_bat": [("hmip_low_bat", "AP1", "thermostat")]
+    }
+    # values of one parameter are alternatives
+    assert _select(registry, device=["window", "3"], **low_bat) == {
+        "hmip_low_bat": [
+            ("hmip_low_bat", "AP1", "hall thermostat"),
+            ("hmip_low_bat", "AP1", "window"),
+        ]
+    }
+    assert _names(registry, room="kitchen", device="hall thermostat") == [
+        "hmip_duty_cycle",
+        "hmip_websocket_events_bytes",
+    ]
+
+
+def test_device_filters_keep_other_series_and_skip_emptied_families():
+    registry = _home()
+    assert _names(registry, type="shutter_contact") == [
+        "hmip_device_info",
+        "hmip_duty_cycle",
+        "hmip_low_bat",
+        "hmip_websocket_events_bytes",
+    ]
+
+
+def test_devices_are_told_apart_by_home():
+    registry = _home()
+    selected = _select(
+        registry,
+        type="wall_mounted_thermostat_pro",
+        **{"name[]": "hmip_current_temperature_celsius"},
+    )
+    assert selected == {
+        "hmip_current_temperature_celsius": [
+            ("hmip_current_temperature_celsius", "AP2", "thermostat")
+        ]
+    }
+
+
+def test_selected_families_are_kept_while_unchanged():
+    registry = _home()
+    selection = exporter.parse_selection(MultiDict(room="kitchen"))
+    selected = exporter.SelectedRegistry(registry, selection)
+    first = {family.name: family for family in selected.collect()}
+    second = {family.name: family for family in selected.collect()}
+    assert all(second[name] is family for name, family in first.items())
+    # unfiltered families are served as they are
+    assert second["hmip_duty_cycle"] is registry.families[3]
+
+    low_bat = GaugeMetricFamily("hmip_low_bat", "", labels=DEVICE_LABELS)
+    low_bat.add_metric(["AP1", "kitchen", "thermostat"], 1)
+    registry.families = registry.families[:1] + (low_bat,) + registry.families[2:]
+    third = {family.name: family for family in selected.collect()}
+    assert third["hmip_low_bat"] is not second["hmip_low_bat"]
+    assert third["hmip_device_info"] is second["hmip_device_info"]
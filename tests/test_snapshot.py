@@ -0,0 +1,188 @@
+"""
+consistency of the published snapshot under concurrent scrapes
+"""
+
+import asyncio
+import copy
+import json
+import threading
+
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.parser import text_string_to_metric_families
+
+import benchmark
+import exporter
+
+DEVICES = 64
+MESSAGES = 150
+
+
+def _message(*events):
+    return json.dumps(
+        {"events": dict(enumerate(events)), "accessPointId": benchmark.HOME_ID}
+    )
+
+
+def _burst(devices, victim, k):
+    """
+    a message setting the temperature and RSSI of all devices to values of k
+    and removing or re-adding the victim
+    """
+    events = []
+    for js in devices:
+        js = copy.deepcopy(js)
+        js["functionalChannels"]["0"]["rssiDeviceValue"] = -(40 + k % 50)
+        js["functionalChannels"]["1"]["actualTemperature"] = 40.0 + k % 50
+        events.append({"pushEventType": "DEVICE_CHANGED", "device": js})
+    if k % 2:
+        events.append({"pushEventType": "DEVICE_REMOVED", "id": victim["id"]})
+    else:
+        events.append({"pushEventType": "DEVICE_ADDED", "device": victim})
+    return _message(*events)
+
+
+def _series_by_device(body):
+    """
+    groups the samples of an exposition by device
+
+    :return: a dict of (room, device label) to a dict of family to value
+    """
+    devices = {}
+    for family in text_string_to_metric_families(body.decode()):
+        for sample in family.samples:
+            if "device_label" not in sample.labels:
+                continue
+            key = (sample.labels["room"], sample.labels["device_label"])
+            devices.setdefault(key, {})[sample.name] = sample.value
+    return devices
+
+
+def _assert_single_snapshot(body, families, thermostats):
+    devices = _series_by_device(body)
+    for key, series in devices.items():
+        # a device is exposed with all of its series or not at all
+        assert "hmip_device_info" in series, key
+        assert series.keys() == families[key], key
+    temperatures = {
+        devices[key]["hmip_current_temperature_celsius"] for key in thermostats
+    }
+    # all thermostats were changed by the same messages
+    assert len(temperatures) == 1, temperatures
+    rssi = {devices[key]["hmip_rssi_device_value"] for key in thermostats}
+    assert rssi == {-t for t in temperatures}
+
+
+def _scrape(scrapes, counts, stop, func):
+    # cached expositions repeat, only distinct ones are checked
+    count = 0
+    while not stop.is_set():
+        scrapes.add(func())
+        count += 1
+    counts.append(count)
+
+
+async def _stress(started):
+    json_state = benchmark.synthetic_state(DEVICES)
+    home = benchmark.FakeHome(json_state)
+    async with started(home) as collector:
+        return await _scrape_while_changing(home, collector, json_state)
+
+
+async def _scrape_while_changing(home, collector, json_state):
+    registry = CollectorRegistry()
+    registry.register(exporter.MultiHomeCollector([collector]))
+    server = exporter.MetricsServer(registry, 0)
+
+    walls = [
+        js
+        for js in json_state["devices"].values()
+        if js["type"] == "WALL_MOUNTED_THERMOSTAT_PRO"
+    ]
+    devices, victim = walls[:-1], walls[-1]
+    await home.deliver(_burst(devices, victim, 0))
+    initial = _series_by_device(generate_latest(registry))
+    families = {key: series.keys() for key, series in initial.items()}
+    thermostats = [key for key in initial if key[1] in {js["label"] for js in devices}]
+
+    scrapes = set()
+    counts = []
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=_scrape,
+            args=(scrapes, counts, stop, lambda: generate_latest(registry)),
+        ),
+        threading.Thread(
+            target=_scrape,
+            args=(scrapes, counts, stop, lambda: server.exposition("", "")[0]),
+        ),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for k in range(1, MESSAGES):
+            await home.deliver(_burst(devices, victim, k))
+            # let the loop serve a scrape between the messages as well
+            scrapes.add(server.exposition("", "")[0])
+            await asyncio.sleep(0)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return scrapes, counts, families, thermostats
+
+
+def test_concurrent_scrapes_see_single_snapshot(started):
+    scrapes, counts, families, thermostats = asyncio.run(_stress(started))
+    assert len(counts) == 2 and min(counts) > 0
+    for body in scrapes:
+        _assert_single_snapshot(body, families, thermostats)
+
+
+def test_published_snapshot_is_never_modified(started):
+    async def check():
+        json_state = benchmark.synthetic_state(DEVICES)
+        home = benchmark.FakeHome(json_state)
+        walls = [
+            js
+            for js in json_state["devices"].values()
+            if js["type"] == "WALL_MOUNTED_THERMOSTAT_PRO"
+        ]
+        group = next(iter(json_state["groups"].values()))
+        async with started(home) as collector:
+            for k in range(1, 20):
+                published = collector._HomematicIPCollector__snapshot
+                frozen = copy.deepcopy(published)
+                renamed = dict(group, label="room {}".format(k))
+                await home.deliver(
+                    _message(
+                        {"pushEventType": "GROUP_CHANGED", "group": renamed},
+                        json.loads(_burst(walls[:-1], walls[-1], k))["events"]["0"],
+                    )
+                )
+                assert published == frozen
+                assert collector._HomematicIPCollector__snapshot is not published
+
+    asyncio.run(check())
+
+
+def test_messages_without_changes_keep_the_snapshot(started):
+    async def check():
+        json_state = benchmark.synthetic_state(DEVICES)
+        home = benchmark.FakeHome(json_state)
+        device = next(iter(json_state["devices"].values()))
+        group = next(iter(json_state["groups"].values()))
+        async with started(home) as collector:
+            published = collector._HomematicIPCollector__snapshot
+            await home.deliver(
+                _message(
+                    {"pushEventType": "DEVICE_CHANGED", "device": device},
+                    {"pushEventType": "GROUP_CHANGED", "group": group},
+                    {"pushEventType": "HOME_CHANGED", "home": json_state["home"]},
+                    {"pushEventType": "DEVICE_REMOVED", "id": "unknown"},
+                )
+            )
+            return published, collector._HomematicIPCollector__snapshot
+
+    published, unchanged = asyncio.run(check())
+    assert unchanged is published
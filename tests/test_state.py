@@ -0,0 +1,70 @@
+"""
+snapshots of the homes saved to --state-dir
+"""
+
+import asyncio
+import marshal
+
+import prometheus_client
+import pytest
+
+import benchmark
+import exporter
+
+
+def _stale():
+    return prometheus_client.REGISTRY.get_sample_value(
+        "hmip_home_stale", {"access_point": benchmark.HOME_ID}
+    )
+
+
+def _snapshot(collector):
+    return collector._HomematicIPCollector__snapshot
+
+
+@pytest.fixture
+def saved(started, tmp_path):
+    """
+    the snapshot a home saved to tmp_path after its initial sync
+    """
+
+    async def save():
+        home = benchmark.FakeHome(benchmark.synthetic_state(16))
+        async with started(home, state_dir=str(tmp_path)) as collector:
+            return _snapshot(collector)
+
+    snapshot = asyncio.run(save())
+    (path,) = tmp_path.iterdir()
+    return snapshot, path
+
+
+def test_saved_snapshot_is_served_until_the_first_sync(started, saved, tmp_path):
+    snapshot, _ = saved
+    home = benchmark.FakeHome(benchmark.synthetic_state(16))
+    # loaded before connecting
+    collector = benchmark._collector(home, state_dir=str(tmp_path))
+    assert _snapshot(collector) == snapshot
+    assert _snapshot(collector).device_samples
+    assert _stale() == 1
+
+    async def check():
+        async with started(home, state_dir=str(tmp_path)):
+            return _stale()
+
+    assert asyncio.run(check()) == 0
+
+
+@pytest.mark.parametrize(
+    "field, value", [(0, exporter.SNAPSHOT_FORMAT + 1), (1, "other")]
+)
+def test_snapshots_of_other_formats_or_homes_are_ignored(saved, tmp_path, field, value):
+    _, path = saved
+    data = list(marshal.loads(path.read_bytes()))
+    data[field] = value
+    path.write_bytes(marshal.dumps(tuple(data)))
+
+    collector = benchmark._collector(
+        benchmark.FakeHome(benchmark.synthetic_state(16)), state_dir=str(tmp_path)
+    )
+    assert _snapshot(collector) == exporter.Snapshot({}, (), {})
+    assert _stale() == 0
@@ -0,0 +1,152 @@
+"""
+REST syncs of a home
+"""
+
+import asyncio
+
+import benchmark
+import exporter
+
+
+def test_targeted_sync_ignores_devices_that_failed_to_collect(started):
+    async def check():
+        json_state = benchmark.synthetic_state(16)
+        devices = list(json_state["devices"].values())
+        broken, device = devices[0], devices[1]
+        del broken["functionalChannels"]
+        async with started(benchmark.FakeHome(json_state)) as collector:
+            rebuilds = []
+            rebuild = collector._HomematicIPCollector__rebuild_snapshot
+
+            def spy(js):
+                rebuilds.append(js)
+                rebuild(js)
+
+            collector._HomematicIPCollector__rebuild_snapshot = spy
+            device["label"] = "renamed"
+            await collector._HomematicIPCollector__sync([device["id"]])
+            snapshot = collector._HomematicIPCollector__snapshot
+        return rebuilds, snapshot, broken, device
+
+    rebuilds, snapshot, broken, device = asyncio.run(check())
+    assert rebuilds == []
+    assert broken["id"] not in snapshot.device_samples
+    assert snapshot.device_samples[device["id"]][0][1][0] == "renamed"
+
+
+def test_targeted_sync_falls_back_to_a_full_sync_for_new_devices(started):
+    async def check():
+        json_state = benchmark.synthetic_state(16)
+        device = dict(next(iter(json_state["devices"].values())))
+        device["id"] = "3014F711A0000000FFFFFFFF"
+        async with started(benchmark.FakeHome(json_state)) as collector:
+            json_state["devices"][device["id"]] = device
+            await collector._HomematicIPCollector__sync([device["id"]])
+            snapshot = collector._HomematicIPCollector__snapshot
+        return snapshot, device
+
+    snapshot, device = asyncio.run(check())
+    assert device["id"] in snapshot.device_samples
+
+
+class _Done(Exception):
+    pass
+
+
+def _schedule(reasons, outcomes=(), connected=True, **args):
+    """
+    runs the periodic collection against scripted waits and syncs
+
+    :param reasons: the reasons the waits for the next sync return in turn
+    :param outcomes: the exceptions the syncs raise in turn, None for success
+    :param connected: whether the WebSocket is connected
+    :return: the delays the collection waited for
+    """
+
+    class Home(benchmark.FakeHome):
+        def websocket_is_connected(self):
+            return connected
+
+    collector = benchmark._collector(Home({}), **args)
+    reasons = list(reasons)
+    outcomes = list(outcomes)
+    delays = []
+
+    async def wait_for_sync(delay):
+        delays.append(delay)
+        if not reasons:
+            raise _Done()
+        return reasons.pop(0)
+
+    async def sync(device_ids=None, priority="routine"):
+        outcome = outcomes.pop(0) if outcomes else None
+        if outcome is not None:
+            raise outcome
+
+    collector._HomematicIPCollector__wait_for_sync = wait_for_sync
+    collector._HomematicIPCollector__sync = sync
+    # every sync is a full one, so none is skipped for a lack of stale devices
+    collector._HomematicIPCollector__sync_scope = lambda full: None
+    try:
+        asyncio.run(collector._HomematicIPCollector__periodic_collection())
+    except _Done:
+        pass
+    return delays
+
+
+def test_interval_doubles_up_to_the_max_while_events_arrive():
+    delays = _schedule(
+        ["interval"] * 5, rest_sync_interval=60, rest_sync_max_interval=600
+    )
+    assert delays == [60, 120, 240, 480, 600, 600]
+
+
+def test_interval_is_reset_after_a_reconnect():
+    delays = _schedule(
+        ["interval", "interval", "reconnect", "interval"],
+        rest_sync_interval=60,
+        rest_sync_max_interval=600,
+    )
+    assert delays == [60, 120, 240, 60, 120]
+
+
+def test_interval_does_not_grow_while_disconnected():
+    delays = _schedule(
+        ["interval"] * 3,
+        connected=False,
+        rest_sync_interval=60,
+        rest_sync_max_interval=600,
+    )
+    assert delays == [60, 60, 60, 60]
+
+
+def test_failed_syncs_are_retried_with_jittered_backoff(monkeypatch):
+    jitter = []
+
+    def uniform(low, high):
+        jitter.append((low, high))
+        return 0.5
+
+    monkeypatch.setattr(exporter.random, "uniform", uniform)
+    delays = _schedule(
+        ["interval"] * 4,
+        [RuntimeError("unavailable")] * 3,
+        rest_sync_interval=60,
+        rest_sync_max_interval=600,
+    )
+    # 30, 60 and 120 seconds halved by the jitter, then the interval again
+    assert delays == [60, 15, 30, 60, 120]
+    assert jitter == [(0.5, 1.0)] * 3
+
+
+def test_throttled_syncs_back_off_longer(monkeypatch):
+    from homematicip.exceptions.connection_exceptions import HmipThrottlingError
+
+    monkeypatch.setattr(exporter.random, "uniform", lambda low, high: high)
+    delays = _schedule(
+        ["interval"] * 4,
+        [HmipThrottlingError("429")] * 3,
+        rest_sync_interval=60,
+        rest_sync_max_interval=3600,
+    )
+    assert delays == [60, 300, 600, 1200, 120]
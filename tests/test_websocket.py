@@ -0,0 +1,144 @@
+"""
+supervision of the WebSocket subscription of a home
+"""
+
+import asyncio
+import json
+import time
+
+import prometheus_client
+import pytest
+
+import benchmark
+import exporter
+
+
+class Home(benchmark.FakeHome):
+    """
+    a home whose WebSocket is connected and lost by connect() and lose()
+
+    The handlers are called as the library calls them, enable_events and
+    disable_events_async record the time of every call.
+    """
+
+    def __init__(self, json_state):
+        super().__init__(json_state)
+        self.connected = True
+        self.enabled = []
+        self.disabled = []
+        self.__handlers = {}
+
+    async def enable_events(self, additional_message_handler=None):
+        self.enabled.append(time.monotonic())
+        await super().enable_events(additional_message_handler)
+
+    async def disable_events_async(self):
+        self.disabled.append(time.monotonic())
+
+    def websocket_is_connected(self):
+        return self.connected
+
+    def set_on_connected_handler(self, handler):
+        self.__handlers["connected"] = handler
+
+    def set_on_disconnected_handler(self, handler):
+        self.__handlers["disconnected"] = handler
+
+    def set_on_reconnect_handler(self, handler):
+        self.__handlers["reconnect"] = handler
+
+    def connect(self):
+        self.connected = True
+        self.__handlers["connected"]()
+
+    def lose(self):
+        # the library calls both when it retries a dropped connection
+        self.connected = False
+        self.__handlers["disconnected"]()
+        self.__handlers["reconnect"]()
+
+
+@pytest.fixture(autouse=True)
+def fast_checks(monkeypatch):
+    monkeypatch.setattr(exporter, "WEBSOCKET_CHECK_INTERVAL", 0.01)
+    monkeypatch.setattr(exporter, "WEBSOCKET_RESTART_DELAY", 0.05)
+    monkeypatch.setattr(exporter, "WEBSOCKET_MAX_RESTART_DELAY", 0.2)
+    # no jitter, the restarts are spaced by the full delay
+    monkeypatch.setattr(exporter.random, "uniform", lambda low, high: high)
+
+
+def _value(name, **labels):
+    labels["access_point"] = benchmark.HOME_ID
+    return prometheus_client.REGISTRY.get_sample_value(name, labels) or 0
+
+
+async def _until(predicate):
+    async with asyncio.timeout(5):
+        while not predicate():
+            await asyncio.sleep(0.01)
+
+
+def test_idle_subscription_is_restarted(started):
+    async def check():
+        home = Home(benchmark.synthetic_state(16))
+        message = json.dumps({"events": {}})
+        before = _value("hmip_websocket_restarts_total", reason="idle")
+        async with started(home) as collector:
+            collector._HomematicIPCollector__event_gap_timeout = 0.1
+            # messages keep the subscription alive
+            for _ in range(20):
+                await home.deliver(message)
+                await asyncio.sleep(0.01)
+            alive = len(home.enabled)
+            await _until(lambda: len(home.enabled) > alive)
+        restarts = _value("hmip_websocket_restarts_total", reason="idle")
+        return alive, home, restarts - before
+
+    alive, home, restarts = asyncio.run(check())
+    assert alive == 1
+    assert len(home.disabled) >= 1
+    assert restarts >= 1
+
+
+def test_subscription_that_stays_down_is_restarted_with_backoff(started):
+    async def check():
+        home = Home(benchmark.synthetic_state(16))
+        before = _value("hmip_websocket_restarts_total", reason="disconnected")
+        async with started(home):
+            home.lose()
+            lost = time.monotonic()
+            await _until(lambda: len(home.enabled) >= 5)
+        restarts = _value("hmip_websocket_restarts_total", reason="disconnected")
+        return home.enabled, lost, restarts - before
+
+    enabled, lost, restarts = asyncio.run(check())
+    assert restarts >= 4
+    gaps = [enabled[1] - lost] + [b - a for a, b in zip(enabled[1:], enabled[2:])]
+    # 0.05s, then doubled per restart up to 0.2s
+    for gap, delay in zip(gaps, (0.05, 0.1, 0.2, 0.2)):
+        assert delay <= gap < delay + 0.15
+
+
+def test_reconnect_is_counted_and_caught_up(started):
+    async def check():
+        home = Home(benchmark.synthetic_state(16))
+        reconnects = _value("hmip_websocket_reconnects_total")
+        catch_ups = _value("hmip_rest_calls_total", priority="catch_up")
+        async with started(home):
+            home.connect()
+            connected = _value("hmip_websocket_connected")
+            home.lose()
+            lost = _value("hmip_websocket_connected")
+            home.connect()
+            await _until(
+                lambda: _value("hmip_rest_calls_total", priority="catch_up") > catch_ups
+            )
+            state = (
+                connected,
+                lost,
+                _value("hmip_websocket_connected"),
+                _value("hmip_websocket_reconnects_total") - reconnects,
+            )
+        return state
+
+    assert asyncio.run(check()) == (1, 0, 1, 1)
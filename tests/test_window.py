@@ -0,0 +1,91 @@
+"""
+aggregates of continuous values per --aggregate-window
+"""
+
+import asyncio
+import copy
+import json
+import time
+
+import pytest
+
+import benchmark
+import exporter
+
+
+class Clock(object):
+    """
+    the time module with a monotonic clock that only moves when told
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(exporter, "time", clock)
+    return clock
+
+
+def _aggregates(collector, label):
+    """
+    :return: a dict of aggregate family to value of the device's temperature
+    """
+    return {
+        family.name[len("hmip_current_temperature_celsius_window_") :]: sample.value
+        for family in collector.collect()
+        if family.name.startswith("hmip_current_temperature_celsius_window_")
+        for sample in family.samples
+        if sample.labels["device_label"] == label
+    }
+
+
+def test_window_aggregates_of_value_changes(started, clock):
+    async def check():
+        json_state = benchmark.synthetic_state(64)
+        device = next(
+            js
+            for js in json_state["devices"].values()
+            if js["type"] == "WALL_MOUNTED_THERMOSTAT_PRO"
+        )
+        device["functionalChannels"]["1"]["actualTemperature"] = 20.0
+        home = benchmark.FakeHome(json_state)
+
+        async def change(seconds, temperature):
+            clock.now += seconds
+            js = copy.deepcopy(device)
+            js["functionalChannels"]["1"]["actualTemperature"] = temperature
+            event = {"pushEventType": "DEVICE_CHANGED", "device": js}
+            await home.deliver(json.dumps({"events": {"0": event}}))
+
+        windows = []
+        async with started(home, aggregate_window=3600) as collector:
+            complete = collector._HomematicIPCollector__complete_window
+            # 20 for 10s, 24 for 20s, 18 for 10s, then 18 again
+            await change(10, 24.0)
+            await change(20, 18.0)
+            await change(10, 18.0)
+            complete()
+            windows.append(_aggregates(collector, device["label"]))
+            clock.now += 30
+            complete()
+            windows.append(_aggregates(collector, device["label"]))
+        return windows
+
+    first, second = asyncio.run(check())
+    assert first == {
+        "min": 18.0,
+        "max": 24.0,
+        "mean": pytest.approx((20 * 10 + 24 * 20 + 18 * 10) / 40),
+        "samples": 3,
+    }
+    # the next window starts from the current value
+    assert second == {"min": 18.0, "max": 18.0, "mean": 18.0, "samples": 1}